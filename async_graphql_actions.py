@@ -0,0 +1,297 @@
+import asyncio
+import json
+import time
+import aiohttp
+from graphql_actions import GRAPHQL_ENDPOINT, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, DEFAULT_RETRIES, DEFAULT_UPDATES_PER_REQUEST, DEFAULT_PAGE_SIZE
+from graphql_actions import permission_entry, permission_update, permission_updates_document, permission_update_results, response_data, response_body
+from concurrent_executor import DEFAULT_CONCURRENCY
+from rate_limiter import is_throttled, is_retryable, retry_delay
+from request_metrics import operation_name
+
+# The asyncio counterparts of the functions in graphql_actions.py, for services running on an event loop.
+# They take an AsyncGraphQLTransport instead of a GraphQLTransport and have to be awaited.
+
+# Network errors after which a request is sent again
+RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+async def get_groups(access_token, workspace_url, transport=None):
+    query = '''
+    query GetGroups($workspaceUrl: String!) {
+        desTeam(workspaceUrl: $workspaceUrl) {
+            groups {
+                id
+                name
+            }
+        }
+    }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    response = await send_graphql_request(query, variables, access_token, transport=transport)
+    return response_data(response)['desTeam']['groups']
+
+async def get_group_id(access_token, workspace_url, group_name, transport=None):
+    for group in await get_groups(access_token, workspace_url, transport):
+        if group['name'] == group_name:
+            return group['id']
+    return None
+
+async def get_users(access_token, workspace_url, transport=None):
+    query = '''
+    query GetUsers($workspaceUrl: String!) {
+        desTeam(workspaceUrl: $workspaceUrl) {
+            users {
+                userId
+                email
+            }
+        }
+    }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    response = await send_graphql_request(query, variables, access_token, transport=transport)
+    return response_data(response)['desTeam']['users']
+
+async def get_user_id(access_token, workspace_url, user_email, transport=None):
+    for user in await get_users(access_token, workspace_url, transport):
+        if user['email'] == user_email:
+            return user['userId']
+    return None
+
+async def iter_projects(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
+    # Follow the desProjects cursor one page at a time, yielding the projects of each page as it arrives
+    query = '''
+        query GetProjects($workspaceUrl: String!, $first: Int!, $after: String) {
+            desProjects(workspaceUrl: $workspaceUrl, first: $first, after: $after) {
+                nodes {
+                    id
+                    name
+                }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+            }
+        }
+    '''
+    after = None
+    while True:
+        variables = {
+            "workspaceUrl": workspace_url,
+            "first": page_size,
+            "after": after
+        }
+        response = await send_graphql_request(query, variables, access_token, transport=transport)
+        projects = response_data(response)['desProjects']
+        for project in projects['nodes']:
+            yield project
+        page_info = projects.get('pageInfo') or {}
+        if not page_info.get('hasNextPage') or not page_info.get('endCursor'):
+            return
+        after = page_info['endCursor']
+
+async def get_projects(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
+    return [project async for project in iter_projects(access_token, workspace_url, transport=transport, page_size=page_size)]
+
+async def get_project_id(access_token, workspace_url, project_name, transport=None):
+    # Stops fetching pages as soon as the project is found
+    async for project in iter_projects(access_token, workspace_url, transport=transport):
+        if project['name'] == project_name:
+            return project['id']
+    return None
+
+async def get_folders(access_token, workspace_url, transport=None):
+    query = '''
+        query GetFolders($workspaceUrl: String!) {
+            desLibrary(workspaceUrl: $workspaceUrl) {
+                folders {
+                    id
+                    path
+                }
+            }
+        }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    response = await send_graphql_request(query, variables, access_token, transport=transport)
+    return response_data(response)['desLibrary']['folders']
+
+async def get_folder_id(access_token, workspace_url, folder_path, transport=None):
+    for folder in await get_folders(access_token, workspace_url, transport):
+        if folder['path'] == folder_path:
+            return folder['id']
+    return None
+
+async def update_folder_permissions(access_token, folder_id, permissions, replace_existing=False, transport=None):
+    succeeded, errors = (await send_permission_updates(access_token, [permission_update("folder", folder_id, permissions, replace_existing)], transport))[0]
+    if not succeeded:
+        print(errors)
+    return succeeded
+
+async def update_project_permissions(access_token, project_id, permissions, replace_existing=False, transport=None):
+    succeeded, errors = (await send_permission_updates(access_token, [permission_update("project", project_id, permissions, replace_existing)], transport))[0]
+    if not succeeded:
+        print(errors)
+    return succeeded
+
+async def update_permissions_batch(access_token, updates, max_per_request=DEFAULT_UPDATES_PER_REQUEST, transport=None):
+    # Send many folder and project permission updates using as few requests as possible, all at once
+    # (the transport bounds how many are actually in flight). Returns a (succeeded, errors) pair for every update, in order.
+    chunks = [updates[start:start + max_per_request] for start in range(0, len(updates), max_per_request)]
+    results = []
+    for chunk_results in await asyncio.gather(*[send_permission_updates(access_token, chunk, transport) for chunk in chunks]):
+        results.extend(chunk_results)
+    return results
+
+async def send_permission_updates(access_token, updates, transport=None):
+    # Send the updates as one document and match every result and error to its update
+    query, variables = permission_updates_document(updates)
+    response = await send_graphql_request(query, variables, access_token, transport=transport)
+    return permission_update_results(updates, response.status_code, response_body(response))
+
+async def add_group_permission_to_folder(access_token, folder_id, group_id, read_only=False, transport=None):
+    # read_only is sent as canModify, like the blocking version
+    return await update_folder_permissions(access_token, folder_id, [permission_entry("group", group_id, read_only)], transport=transport)
+
+async def add_user_permission_to_folder(access_token, folder_id, user_id, read_only=False, transport=None):
+    return await update_folder_permissions(access_token, folder_id, [permission_entry("user", user_id, read_only)], transport=transport)
+
+async def add_anyone_permission_to_folder(access_token, folder_id, read_only=False, transport=None):
+    return await update_folder_permissions(access_token, folder_id, [permission_entry("anyone", None, read_only)], transport=transport)
+
+async def clear_all_permissions_on_folder(access_token, folder_id, transport=None):
+    return await update_folder_permissions(access_token, folder_id, [], replace_existing=True, transport=transport)
+
+async def add_group_permission_to_project(access_token, project_id, group_id, read_only=False, transport=None):
+    return await update_project_permissions(access_token, project_id, [permission_entry("group", group_id, read_only)], transport=transport)
+
+async def add_user_permission_to_project(access_token, project_id, user_id, read_only=False, transport=None):
+    return await update_project_permissions(access_token, project_id, [permission_entry("user", user_id, read_only)], transport=transport)
+
+async def add_anyone_permission_to_project(access_token, project_id, read_only=False, transport=None):
+    return await update_project_permissions(access_token, project_id, [permission_entry("anyone", None, read_only)], transport=transport)
+
+async def clear_all_permissions_on_project(access_token, project_id, transport=None):
+    return await update_project_permissions(access_token, project_id, [], replace_existing=True, transport=transport)
+
+# The body of an API response, read while the connection was held, with the parts of the requests.Response
+# interface used by the rate limiter and the functions above.
+class GraphQLResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+# Sends GraphQL requests on one aiohttp session, keeping up to pool_size connections open and at most
+# concurrency requests in flight; any number of coroutines can share it.
+# The rate limiter, retries, token source and metrics behave as in GraphQLTransport.
+# The session is created on first use and belongs to the event loop it was created on.
+class AsyncGraphQLTransport:
+    def __init__(self, graphql_endpoint=GRAPHQL_ENDPOINT, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, concurrency=DEFAULT_CONCURRENCY,
+                 rate_limiter=None, retries=DEFAULT_RETRIES, token_source=None, metrics=None):
+        self.graphql_endpoint = graphql_endpoint
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.token_source = token_source
+        self.metrics = metrics
+        self.session = None
+        self.semaphore = None
+
+    def open(self):
+        if self.session is None or self.session.closed:
+            connect_timeout, read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                 timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def post(self, query, variables, access_token, graphql_endpoint=None):
+        endpoint = graphql_endpoint if graphql_endpoint is not None else self.graphql_endpoint
+        data = json.dumps({ "query": query, "variables": variables }).encode()
+        if self.metrics is None:
+            return (await self.send(endpoint, data, access_token))[0]
+        start = time.monotonic()
+        try:
+            response, retries = await self.send(endpoint, data, access_token)
+        except Exception:
+            self.metrics.record(operation_name(query), time.monotonic() - start, len(data), 0, None, self.retries)
+            raise
+        self.metrics.record(operation_name(query), time.monotonic() - start, len(data), len(response.content), response.status_code, retries)
+        return response
+
+    async def send(self, endpoint, data, access_token):
+        # Returns the final response and the number of times the request was sent again
+        session = self.open()
+        if self.token_source is not None:
+            # Fetching a token may block on the identity server or the browser sign-in, so it runs in a thread
+            access_token = await asyncio.to_thread(self.token_source.access_token)
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.try_acquire()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.rate_limiter.try_acquire()
+            headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
+            try:
+                async with self.semaphore:
+                    async with session.post(endpoint, data=data, headers=headers) as http_response:
+                        response = GraphQLResponse(http_response.status, http_response.headers, await http_response.read())
+            except RETRYABLE_EXCEPTIONS:
+                if attempt >= self.retries:
+                    raise
+                await asyncio.sleep(retry_delay(None, attempt))
+                attempt += 1
+                continue
+            if response.status_code == 401 and self.token_source is not None and not refreshed:
+                # The token expired or was revoked; renewing it may block on the identity server, so it runs in a thread
+                access_token = await asyncio.to_thread(self.token_source.refresh, access_token)
+                refreshed = True
+                continue
+            if not is_retryable(response):
+                if self.rate_limiter is not None:
+                    self.rate_limiter.succeeded()
+                return response, attempt + refreshed
+            if self.rate_limiter is not None and is_throttled(response):
+                self.rate_limiter.throttled()
+            if attempt >= self.retries:
+                return response, attempt + refreshed
+            await asyncio.sleep(retry_delay(response, attempt))
+            attempt += 1
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+default_transports = {}
+
+def get_default_transport():
+    # Shared by every call on the running event loop that is not given its own transport
+    loop = asyncio.get_running_loop()
+    if loop not in default_transports:
+        for closed_loop in [other for other in default_transports if other.is_closed()]:
+            del default_transports[closed_loop]
+        default_transports[loop] = AsyncGraphQLTransport()
+    return default_transports[loop]
+
+async def send_graphql_request(query, variables, access_token, graphql_endpoint=None, transport=None):
+    if transport is None:
+        transport = get_default_transport()
+    return await transport.post(query, variables, access_token, graphql_endpoint)
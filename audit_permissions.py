@@ -0,0 +1,233 @@
+import argparse
+import csv
+import json
+import os
+import time
+import dotenv
+import requests
+from graphql_actions import iter_folders_with_permissions, iter_projects_with_permissions
+from graphql_actions import GraphQLTransport, GraphQLError, DEFAULT_POOL_SIZE, DEFAULT_PAGE_SIZE
+from concurrent_executor import iter_prefetched, DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from workspace_resolver import WorkspaceResolver
+from bulk_permissions import TARGET_TYPES
+from token_manager import TokenManager
+from request_metrics import RequestMetrics, report
+from workspace_fanout import single_workspace
+
+EXPORT_FORMATS = ["csv", "jsonl", "parquet"]
+# The manifest columns first, so an export can be used as a reconcile_permissions.py manifest
+EXPORT_COLUMNS = ["target_type", "target", "principal_type", "principal", "can_modify", "target_id", "principal_id"]
+# Number of rows buffered before a Parquet row group is written
+PARQUET_ROW_GROUP_SIZE = 10000
+PRINCIPAL_TYPES_BY_SCOPE = { "GROUP": "group", "USER": "user", "ANYONE": "anyone" }
+
+class Options:
+    def __init__(self):
+        # Load the environment variables from the .env file
+        dotenv.load_dotenv()
+
+        # These options can only come from the environment or the .env file
+        self.client_id = os.getenv('NEXAR_CLIENT_ID')
+        self.client_secret = os.getenv('NEXAR_CLIENT_SECRET')
+
+        # The scopes are set to the required scopes for this script
+        self.scopes = ["user.access", "design.domain"]
+
+        parsed_args = self.parse_args()
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Request timings are only collected when asked to
+        self.profile = parsed_args.profile or parsed_args.profile_output is not None
+        self.profile_output = parsed_args.profile_output
+
+        # Workspace can be passed via an argument, an environment variable, or the .env file
+        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # Remaining values are passed through arguments
+        self.output = parsed_args.output
+        self.format = parsed_args.format if (parsed_args.format is not None) else export_format_from_path(parsed_args.output)
+        self.target_types = parsed_args.type or TARGET_TYPES
+
+        # Connection settings for the API
+        self.pool_size = parsed_args.pool_size
+        self.timeout = parsed_args.timeout
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Export the permissions of every folder and project in a workspace')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('-o', '--output', help='The path of the OUTPUT file', required=True)
+        args.add_argument('--format', help='The format of the output (detected from the file extension by default)', choices=EXPORT_FORMATS)
+        args.add_argument('-t', '--type', help='Only export this type of target (can be repeated, both by default)', choices=TARGET_TYPES, action='append')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--timeout', help='The number of seconds to wait for each API response', type=float, default=120)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        args.add_argument('--profile', help='Print the time, size and retries of the API requests by operation at the end of the run', action='store_true')
+        args.add_argument('--profile-output', help='Also write every API request to this file as JSON lines (or Prometheus metrics for a .prom file)')
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
+        return args.parse_args()
+
+def export_format_from_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.jsonl', '.ndjson']:
+        return "jsonl"
+    if extension in ['.parquet', '.pq']:
+        return "parquet"
+    return "csv"
+
+# Writes export rows to a file as they are produced; only Parquet buffers rows, one row group at a time.
+class AuditWriter:
+    def __init__(self, path, export_format):
+        self.export_format = export_format
+        self.rows = []
+        self.parquet = None
+        if export_format == "parquet":
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("Writing Parquet files requires pyarrow: python3 -m pip install pyarrow")
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([(column, pyarrow.bool_() if column == "can_modify" else pyarrow.string()) for column in EXPORT_COLUMNS])
+            self.parquet = pyarrow.parquet.ParquetWriter(path, self.schema)
+        elif export_format in ["csv", "jsonl"]:
+            self.file = open(path, 'w', newline='' if export_format == "csv" else None)
+            if export_format == "csv":
+                self.csv = csv.DictWriter(self.file, EXPORT_COLUMNS)
+                self.csv.writeheader()
+        else:
+            raise ValueError(f"Unsupported export format '{export_format}'")
+
+    def write(self, row):
+        if self.export_format == "csv":
+            self.csv.writerow(dict(row, can_modify="true" if row['can_modify'] else "false"))
+        elif self.export_format == "jsonl":
+            self.file.write(json.dumps(row) + "\n")
+        else:
+            self.rows.append(row)
+            if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+                self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.parquet.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        if self.parquet is not None:
+            self.flush()
+            self.parquet.close()
+        else:
+            self.file.close()
+
+def permission_rows(resolver, target_type, target, target_id, permissions):
+    # One row per permission, with the group and user IDs translated back to names
+    for permission in permissions:
+        principal_type = PRINCIPAL_TYPES_BY_SCOPE.get(permission.get('scope'), str(permission.get('scope')).lower())
+        principal_id = permission.get('groupId') if principal_type == "group" else permission.get('userId') if principal_type == "user" else None
+        principal = resolver.name(principal_type, principal_id) if principal_id is not None else None
+        yield {
+            "target_type": target_type,
+            "target": target,
+            "principal_type": principal_type,
+            "principal": principal,
+            "can_modify": bool(permission.get('canModify')),
+            "target_id": target_id,
+            "principal_id": principal_id
+        }
+
+def audit(access_token, resolver, writer, target_types, transport=None, concurrency=DEFAULT_CONCURRENCY):
+    # Stream the permissions of every target into the writer. The folder list, the project pages and the group and
+    # user lists are all downloaded at the same time; the project pages are read at most two pages ahead of the writer.
+    start = time.monotonic()
+    streams = []
+    if "folder" in target_types:
+        folders = iter_folders_with_permissions(access_token, resolver.workspace_url, transport)
+        streams.append(("folder", 'path', iter_prefetched(folders, 1)))
+    if "project" in target_types:
+        projects = iter_projects_with_permissions(access_token, resolver.workspace_url, transport=transport, page_size=resolver.page_size)
+        streams.append(("project", 'name', iter_prefetched(projects, resolver.page_size * 2)))
+    resolver.prefetch(["group", "user"], concurrency)
+
+    summary = { "targets": 0, "permissions": 0, "unshared": 0, "unresolved": 0 }
+    for target_type, name_field, targets in streams:
+        for target in targets:
+            summary['targets'] += 1
+            permissions = target.get('permissions') or []
+            if not permissions:
+                summary['unshared'] += 1
+            for row in permission_rows(resolver, target_type, target[name_field], target['id'], permissions):
+                if row['principal_id'] is not None and row['principal'] is None:
+                    summary['unresolved'] += 1
+                writer.write(row)
+                summary['permissions'] += 1
+    summary['elapsed'] = time.monotonic() - start
+    return summary
+
+def print_summary(summary, output):
+    rate = summary['targets'] / summary['elapsed'] if summary['elapsed'] > 0 else 0.0
+    print(f"Exported {summary['permissions']} permissions of {summary['targets']} targets to '{output}' in {summary['elapsed']:.2f}s "
+          f"({rate:.1f} targets/s): {summary['unshared']} targets without permissions, {summary['unresolved']} groups or users not found.")
+
+def main():
+    # Load all the relevant environment and command line options
+    options = Options()
+
+    # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+    token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                 client_credentials=options.client_credentials, persist=options.token_cache)
+    access_token = None
+    try:
+        access_token = token_manager.access_token()
+    except:
+        access_token = None
+
+    # Validate the access token
+    if (access_token is None):
+        print("Unable to retrieve access token.")
+        exit()
+
+    # Validate the workspace
+    workspace_error = single_workspace(options.workspace)
+    if workspace_error is not None:
+        print(workspace_error)
+        exit()
+    print(f"Workspace URL: {options.workspace}")
+
+    # Export the permissions
+    try:
+        writer = AuditWriter(options.output, options.format)
+    except RuntimeError as error:
+        print(error)
+        exit()
+    metrics = RequestMetrics() if options.profile else None
+    transport = GraphQLTransport(pool_size=max(options.pool_size, options.concurrency), timeout=(10, options.timeout),
+                                 rate_limiter=TokenBucket(options.rate_limit), token_source=token_manager, metrics=metrics)
+    resolver = WorkspaceResolver(access_token, options.workspace, transport=transport, page_size=options.page_size)
+    try:
+        summary = audit(access_token, resolver, writer, options.target_types, transport, options.concurrency)
+    except (GraphQLError, requests.RequestException) as error:
+        # Requests are retried before getting here, so the API or the network is down and the export is incomplete
+        print(f"Stopped: {error}")
+        print(f"'{options.output}' only contains the permissions exported before the error.")
+        writer.close()
+        report(metrics, options.profile_output)
+        transport.close()
+        exit(1)
+    writer.close()
+    print_summary(summary, options.output)
+    report(metrics, options.profile_output)
+    transport.close()
+
+if __name__ == "__main__":
+    main()
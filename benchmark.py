@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from graphql_actions import GraphQLTransport, update_folder_permissions, unsupported_filters, permission_entry, DEFAULT_POOL_SIZE, DEFAULT_UPDATES_PER_REQUEST, DEFAULT_PAGE_SIZE
+from concurrent_executor import DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket
+from workspace_resolver import WorkspaceResolver
+from id_cache import IdCache
+from bulk_permissions import BulkRunner, run_manifest, DEFAULT_BATCH_SIZE
+from reconcile_permissions import reconcile
+from audit_permissions import AuditWriter, audit
+from request_metrics import RequestMetrics, percentile_of
+from mock_server import MockWorkspace, start_mock_server, mock_folder_path, add_workspace_arguments
+
+SCENARIOS = ["lookups", "single-grant", "batch", "stale-cache", "reconcile", "audit"]
+WORKSPACE_URL = 'https://benchmark.365.altium.com/'
+
+class Options:
+    def __init__(self):
+        parsed_args = self.parse_args()
+
+        # The workspace served by the mock server
+        self.groups = parsed_args.groups
+        self.users = parsed_args.users
+        self.folders = parsed_args.folders
+        self.projects = parsed_args.projects
+        self.latency = parsed_args.latency
+        self.jitter = parsed_args.jitter
+        self.throttle_rate = parsed_args.throttle_rate
+        self.filters = not parsed_args.no_filters
+
+        # What to run
+        self.scenarios = parsed_args.scenario or SCENARIOS
+        self.grants = parsed_args.grants
+        self.targets = parsed_args.targets
+        self.repeat = parsed_args.repeat
+        self.seed = parsed_args.seed
+        self.output = parsed_args.output
+
+        # Client settings, as in the scripts
+        self.pool_size = parsed_args.pool_size
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.batch_size = parsed_args.batch_size
+        self.updates_per_request = parsed_args.updates_per_request
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Measure the scripts against a local mock of the Nexar API')
+        add_workspace_arguments(args)
+        args.add_argument('-s', '--scenario', help='A scenario to run (can be repeated, all by default)', choices=SCENARIOS, action='append')
+        args.add_argument('--grants', help='The number of grants applied by the batch scenario', type=int, default=10000)
+        args.add_argument('--targets', help='The number of folders and projects in the reconcile manifest', type=int, default=1000)
+        args.add_argument('--repeat', help='The number of times the single-grant scenario is run', type=int, default=20)
+        args.add_argument('--seed', help='The seed for the generated manifests', type=int, default=1)
+        args.add_argument('--output', help='Also write the results to this file as JSON')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second (0 disables the limit)', type=float, default=0)
+        args.add_argument('--batch-size', help='The number of manifest rows combined into per-target updates at once', type=int, default=DEFAULT_BATCH_SIZE)
+        args.add_argument('--updates-per-request', help='The number of folder and project updates sent in each request', type=int, default=DEFAULT_UPDATES_PER_REQUEST)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        return args.parse_args()
+
+def new_transport(options, endpoint, metrics):
+    rate_limiter = TokenBucket(options.rate_limit) if options.rate_limit else None
+    return GraphQLTransport(endpoint, pool_size=max(options.pool_size, options.concurrency), rate_limiter=rate_limiter, metrics=metrics)
+
+def random_grant(generator, options):
+    target_type = generator.choice(["folder", "project"])
+    target = mock_folder_path(generator.randrange(options.folders)) if target_type == "folder" else f"Project {generator.randrange(options.projects)}"
+    principal_type = generator.choice(["group", "user", "user", "anyone"])
+    principal = f"Group {generator.randrange(options.groups)}" if principal_type == "group" else f"user{generator.randrange(options.users)}@example.com" if principal_type == "user" else None
+    return { "target_type": target_type, "target": target, "principal_type": principal_type, "principal": principal,
+             "can_modify": generator.random() < 0.5 }
+
+def run_lookups(options, workspace, endpoint, metrics):
+    # Download and index every collection, as a cold run of any script does
+    transport = new_transport(options, endpoint, metrics)
+    resolver = WorkspaceResolver("benchmark", WORKSPACE_URL, transport=transport, page_size=options.page_size)
+    resolver.prefetch(["group", "user", "folder", "project"], options.concurrency)
+    transport.close()
+    return options.groups + options.users + options.folders + options.projects, []
+
+def run_single_grant(options, workspace, endpoint, metrics):
+    # One folder_permissions.py run: a new connection, the folder and group lookups, and one update.
+    # Like separate runs of the script, every iteration tries the filtered lookups again.
+    generator = random.Random(options.seed)
+    latencies = []
+    for _ in range(options.repeat):
+        start = time.monotonic()
+        unsupported_filters.clear()
+        transport = new_transport(options, endpoint, metrics)
+        resolver = WorkspaceResolver("benchmark", WORKSPACE_URL, transport=transport, page_size=options.page_size)
+        folder_id = resolver.find("folder", mock_folder_path(generator.randrange(options.folders)))
+        group_id = resolver.find("group", f"Group {generator.randrange(options.groups)}")
+        update_folder_permissions("benchmark", folder_id, [permission_entry("group", group_id, True)], transport=transport)
+        transport.close()
+        latencies.append(time.monotonic() - start)
+    return options.repeat, latencies
+
+def run_batch(options, workspace, endpoint, metrics):
+    # A bulk_permissions.py run over a generated manifest
+    generator = random.Random(options.seed)
+    rows = [random_grant(generator, options) for _ in range(options.grants)]
+    transport = new_transport(options, endpoint, metrics)
+    runner = BulkRunner("benchmark", WORKSPACE_URL, transport=transport, page_size=options.page_size)
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = run_manifest(runner, rows, options.concurrency, options.batch_size, options.updates_per_request)
+    transport.close()
+    return summary['total'], []
+
+def run_stale_cache(options, workspace, endpoint, metrics):
+    # A bulk_permissions.py --cache run over the batch manifest with an out of date ID cache: every tenth group, user,
+    # folder and project has a stale ID and one cached group has since been deleted, so rejected updates are retried with fresh IDs
+    generator = random.Random(options.seed)
+    rows = []
+    deleted = 0
+    for index in range(options.grants):
+        rows.append(random_grant(generator, options))
+        if index % 100 == 50:
+            # Shares its batch with stale IDs, so the deleted group is only noticed after another update refreshes the groups
+            rows.append(dict(random_grant(generator, options), principal_type="group", principal="Deleted group"))
+            deleted += 1
+    with tempfile.TemporaryDirectory() as directory:
+        id_cache = IdCache(os.path.join(directory, "ids.sqlite"))
+        # The indexes are fetched on a transport without metrics, so only the run itself is measured
+        seed_transport = new_transport(options, endpoint, None)
+        seed_resolver = WorkspaceResolver("benchmark", WORKSPACE_URL, transport=seed_transport, page_size=options.page_size)
+        for entity_type in ["group", "user", "folder", "project"]:
+            entries = seed_resolver.fetch_index(entity_type)
+            for index, name in enumerate(sorted(entries)):
+                if index % 10 == 0:
+                    entries[name] = f"stale-{entries[name]}"
+            if entity_type == "group":
+                entries["Deleted group"] = "group-deleted"
+            id_cache.store(WORKSPACE_URL, entity_type, entries)
+        seed_transport.close()
+
+        transport = new_transport(options, endpoint, metrics)
+        runner = BulkRunner("benchmark", WORKSPACE_URL, id_cache, transport, options.page_size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = run_manifest(runner, rows, options.concurrency, options.batch_size, options.updates_per_request)
+        transport.close()
+    # Only the rows naming the deleted group, and the rows combined with them into the same update, can fail once the stale IDs have been refreshed
+    deleted_targets = { (row['target_type'], row['target']) for row in rows if row['principal'] == "Deleted group" }
+    sharing = sum(1 for row in rows if (row['target_type'], row['target']) in deleted_targets)
+    if not deleted <= summary['failed'] <= sharing:
+        raise RuntimeError(f"{summary['failed']} rows failed with a stale ID cache, expected {deleted} to {sharing}")
+    return summary['total'], []
+
+def run_reconcile(options, workspace, endpoint, metrics):
+    # A reconcile_permissions.py run that changes every target, then one that finds nothing to change
+    generator = random.Random(options.seed)
+    rows = []
+    for index in range(options.targets):
+        grant = random_grant(generator, options)
+        grant['target_type'] = "folder" if index % 2 == 0 else "project"
+        grant['target'] = mock_folder_path(index // 2 % options.folders) if index % 2 == 0 else f"Project {index // 2 % options.projects}"
+        rows.append(grant)
+    latencies = []
+    for _ in range(2):
+        start = time.monotonic()
+        transport = new_transport(options, endpoint, metrics)
+        resolver = WorkspaceResolver("benchmark", WORKSPACE_URL, transport=transport, page_size=options.page_size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reconcile("benchmark", resolver, rows, transport, False, options.concurrency, options.updates_per_request)
+        transport.close()
+        latencies.append(time.monotonic() - start)
+    return len(rows) * 2, latencies
+
+def run_audit(options, workspace, endpoint, metrics):
+    # An audit_permissions.py export of every folder and project, after giving each of them a few permissions
+    generator = random.Random(options.seed)
+    for target_type, targets in [("folder", workspace.folders), ("project", workspace.projects)]:
+        for target in targets:
+            grants = [random_grant(generator, options) for _ in range(3)]
+            permissions = [permission_entry(grant['principal_type'], principal_id(grant['principal_type'], grant['principal']), grant['can_modify'])
+                           for grant in grants]
+            workspace.update(target_type, target['id'], permissions, True)
+    transport = new_transport(options, endpoint, metrics)
+    resolver = WorkspaceResolver("benchmark", WORKSPACE_URL, transport=transport, page_size=options.page_size)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = AuditWriter(os.path.join(directory, "audit.csv"), "csv")
+        summary = audit("benchmark", resolver, writer, ["folder", "project"], transport, options.concurrency)
+        writer.close()
+    transport.close()
+    return summary['targets'], []
+
+def principal_id(principal_type, principal):
+    # The mock IDs of the principals named by random_grant
+    if principal_type == "group":
+        return f"group-{principal.split()[-1]}"
+    if principal_type == "user":
+        return f"user-{principal[len('user'):principal.index('@')]}"
+    return None
+
+SCENARIO_FUNCTIONS = { "lookups": run_lookups, "single-grant": run_single_grant, "batch": run_batch, "stale-cache": run_stale_cache, "reconcile": run_reconcile, "audit": run_audit }
+
+def run_scenario(options, scenario):
+    # Every scenario gets a fresh workspace and server so earlier scenarios don't change its results
+    workspace = MockWorkspace(options.groups, options.users, options.folders, options.projects)
+    server, endpoint = start_mock_server(workspace, latency=options.latency, jitter=options.jitter, throttle_rate=options.throttle_rate, filters=options.filters)
+    unsupported_filters.clear()
+    metrics = RequestMetrics()
+    start = time.monotonic()
+    operations, run_latencies = SCENARIO_FUNCTIONS[scenario](options, workspace, endpoint, metrics)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    server.server_close()
+
+    summary = metrics.summary()
+    request_latencies = sorted(entry['elapsed'] for entry in metrics.records)
+    result = {
+        "scenario": scenario,
+        "elapsed": elapsed,
+        "operations": operations,
+        "throughput": operations / elapsed if elapsed > 0 else 0.0,
+        "requests": len(metrics.records),
+        "throttled": server.RequestHandlerClass.stats['throttled'],
+        "retries": sum(statistics['retries'] for statistics in summary.values()),
+        "request_p50": percentile_of(request_latencies, 50),
+        "request_p95": percentile_of(request_latencies, 95),
+        "run_p50": percentile_of(sorted(run_latencies), 50) if run_latencies else None,
+        "operations_by_type": { operation: statistics['count'] for operation, statistics in summary.items() }
+    }
+    return result
+
+def print_results(results):
+    print(f"{'Scenario':<14} {'Time s':>8} {'Ops':>8} {'Ops/s':>9} {'Requests':>9} {'Throttled':>9} {'Retries':>7} {'Req p50 ms':>10} {'Req p95 ms':>10} {'Run p50 ms':>10}")
+    for result in results:
+        run_p50 = f"{result['run_p50'] * 1000:.1f}" if result['run_p50'] is not None else "-"
+        print(f"{result['scenario']:<14} {result['elapsed']:>8.2f} {result['operations']:>8} {result['throughput']:>9.1f} {result['requests']:>9} "
+              f"{result['throttled']:>9} {result['retries']:>7} {result['request_p50'] * 1000:>10.1f} {result['request_p95'] * 1000:>10.1f} {run_p50:>10}")
+
+def main():
+    options = Options()
+    print(f"Mock workspace: {options.groups} groups, {options.users} users, {options.folders} folders, {options.projects} projects; "
+          f"latency {options.latency * 1000:.0f} ms (+{options.jitter * 1000:.0f} ms jitter), throttle rate {options.throttle_rate or 'off'}")
+    results = []
+    for scenario in options.scenarios:
+        print(f"Running {scenario}...")
+        results.append(run_scenario(options, scenario))
+    print_results(results)
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump({ "options": vars(options), "results": results }, output, indent=2)
+        print(f"Results written to '{options.output}'.")
+
+if __name__ == "__main__":
+    main()
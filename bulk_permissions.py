@@ -0,0 +1,352 @@
+import argparse
+import csv
+import json
+import os
+import time
+import dotenv
+import requests
+from itertools import islice
+from graphql_actions import permission_entry, permission_update, update_permissions_batch
+from graphql_actions import GraphQLTransport, GraphQLError, DEFAULT_POOL_SIZE, DEFAULT_UPDATES_PER_REQUEST, DEFAULT_PAGE_SIZE
+from concurrent_executor import run_ordered, DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from workspace_resolver import WorkspaceResolver
+from id_cache import IdCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL
+from token_manager import TokenManager
+from request_metrics import RequestMetrics, report
+from checkpoint_journal import CheckpointJournal, file_fingerprint
+from workspace_fanout import single_workspace
+
+MANIFEST_FORMATS = ["csv", "jsonl", "yaml"]
+TARGET_TYPES = ["folder", "project"]
+PRINCIPAL_TYPES = ["group", "user", "anyone"]
+# Number of manifest rows read at once; grants for the same target within a batch are sent as one update
+DEFAULT_BATCH_SIZE = 1000
+
+class Options:
+    def __init__(self):
+        # Load the environment variables from the .env file
+        dotenv.load_dotenv()
+
+        # These options can only come from the environment or the .env file
+        self.client_id = os.getenv('NEXAR_CLIENT_ID')
+        self.client_secret = os.getenv('NEXAR_CLIENT_SECRET')
+
+        # The scopes are set to the required scopes for this script
+        self.scopes = ["user.access", "design.domain"]
+
+        parsed_args = self.parse_args()
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Request timings are only collected when asked to
+        self.profile = parsed_args.profile or parsed_args.profile_output is not None
+        self.profile_output = parsed_args.profile_output
+
+        # Workspace can be passed via an argument, an environment variable, or the .env file
+        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # Remaining values are passed through arguments
+        self.manifest = parsed_args.manifest
+        self.format = parsed_args.format if (parsed_args.format is not None) else manifest_format_from_path(parsed_args.manifest)
+        self.checkpoint = parsed_args.checkpoint
+
+        # Workspace IDs are only cached on disk when asked to
+        self.cache = parsed_args.cache or parsed_args.refresh_cache
+        self.cache_path = parsed_args.cache_path
+        self.cache_ttl = parsed_args.cache_ttl
+        self.refresh_cache = parsed_args.refresh_cache
+
+        # Connection settings for the API
+        self.pool_size = parsed_args.pool_size
+        self.timeout = parsed_args.timeout
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.batch_size = parsed_args.batch_size
+        self.updates_per_request = parsed_args.updates_per_request
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Add permissions to folders and projects from a manifest file')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('-m', '--manifest', help='The path of the MANIFEST listing the permissions to add', required=True)
+        args.add_argument('--format', help='The format of the manifest (detected from the file extension by default)', choices=MANIFEST_FORMATS)
+        args.add_argument('--checkpoint', help='Record the applied rows in this file and skip the rows it already lists, so an interrupted run can be resumed')
+        args.add_argument('--cache', help='Cache workspace IDs on disk between runs', action='store_true')
+        args.add_argument('--cache-path', help='The path of the ID cache file', default=DEFAULT_CACHE_PATH)
+        args.add_argument('--cache-ttl', help='The number of seconds cached IDs stay valid', type=int, default=DEFAULT_CACHE_TTL)
+        args.add_argument('--refresh-cache', help='Discard the cached IDs for the workspace before running', action='store_true')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--timeout', help='The number of seconds to wait for each API response', type=float, default=120)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--batch-size', help='The number of manifest rows combined into per-target updates at once', type=int, default=DEFAULT_BATCH_SIZE)
+        args.add_argument('--updates-per-request', help='The number of folder and project updates sent in each request', type=int, default=DEFAULT_UPDATES_PER_REQUEST)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        args.add_argument('--profile', help='Print the time, size and retries of the API requests by operation at the end of the run', action='store_true')
+        args.add_argument('--profile-output', help='Also write every API request to this file as JSON lines (or Prometheus metrics for a .prom file)')
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
+        return args.parse_args()
+
+def manifest_format_from_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.yaml', '.yml']:
+        return "yaml"
+    if extension in ['.jsonl', '.ndjson']:
+        return "jsonl"
+    return "csv"
+
+def parse_can_modify(value):
+    # Accept real booleans (JSONL/YAML) as well as the usual spellings found in CSV files
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return True
+    text = str(value).strip().lower()
+    if text in ['', 'true', 'yes', 'y', '1', 'write']:
+        return True
+    if text in ['false', 'no', 'n', '0', 'read', 'read-only']:
+        return False
+    raise ValueError(f"Invalid can_modify value '{value}'")
+
+def normalize_row(row):
+    # Each manifest row describes one grant: target, principal and whether the principal can modify the target
+    target_type = str(row.get('target_type') or '').strip().lower()
+    principal_type = str(row.get('principal_type') or '').strip().lower()
+    if target_type not in TARGET_TYPES:
+        raise ValueError(f"Invalid target_type '{row.get('target_type')}'")
+    if principal_type not in PRINCIPAL_TYPES:
+        raise ValueError(f"Invalid principal_type '{row.get('principal_type')}'")
+    target = row.get('target')
+    if not target:
+        raise ValueError("Missing target")
+    principal = row.get('principal')
+    if principal_type != "anyone" and not principal:
+        raise ValueError(f"Missing principal for principal_type '{principal_type}'")
+    return {
+        "target_type": target_type,
+        "target": target,
+        "principal_type": principal_type,
+        "principal": principal if principal_type != "anyone" else None,
+        "can_modify": parse_can_modify(row.get('can_modify'))
+    }
+
+def read_manifest(path, manifest_format):
+    # Rows are yielded one at a time so large manifests are never held in memory (YAML has to be parsed as a whole)
+    if manifest_format == "csv":
+        with open(path, newline='') as manifest:
+            for row in csv.DictReader(manifest):
+                yield row
+    elif manifest_format == "jsonl":
+        with open(path) as manifest:
+            for line in manifest:
+                if line.strip():
+                    yield json.loads(line)
+    elif manifest_format == "yaml":
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("Reading YAML manifests requires PyYAML: python3 -m pip install pyyaml")
+        with open(path) as manifest:
+            for row in yaml.safe_load(manifest) or []:
+                yield row
+    else:
+        raise ValueError(f"Unsupported manifest format '{manifest_format}'")
+
+class BulkRunner:
+    def __init__(self, access_token, workspace_url, id_cache=None, transport=None, page_size=DEFAULT_PAGE_SIZE):
+        self.access_token = access_token
+        self.workspace_url = workspace_url
+        # One pooled connection is shared by every request of the run
+        self.transport = transport if transport is not None else GraphQLTransport()
+        # Every collection is fetched at most once per run and indexed for the lookups
+        self.resolver = WorkspaceResolver(access_token, workspace_url, id_cache, self.transport, page_size)
+
+    def resolve(self, entity_type, name):
+        return self.resolver.resolve(entity_type, name)
+
+    def missing(self, grant):
+        # Returns why the grant can't be applied when its target or principal doesn't exist
+        if self.resolve(grant['target_type'], grant['target']) is None:
+            return f"{grant['target_type'].capitalize()} '{grant['target']}' not found."
+        if grant['principal_type'] != "anyone" and self.resolve(grant['principal_type'], grant['principal']) is None:
+            return f"{grant['principal_type'].capitalize()} '{grant['principal']}' not found."
+        return None
+
+    def permissions(self, grants, principal_ids):
+        principal_ids = iter(principal_ids)
+        return [
+            permission_entry(grant['principal_type'], next(principal_ids) if grant['principal_type'] != "anyone" else None, grant['can_modify'])
+            for grant in grants
+        ]
+
+    def principal_lookups(self, grants):
+        return [(grant['principal_type'], grant['principal']) for grant in grants if grant['principal_type'] != "anyone"]
+
+    def apply_targets(self, targets):
+        # Send the updates for many targets in one request; returns (succeeded, errors) per (target_type, target, grants)
+        # and the number of requests sent. Updates that failed while using cached IDs are sent again together with fresh IDs.
+        requests = [0]
+
+        def build(item):
+            target_type, target, grants = item
+            lookups = self.principal_lookups(grants)
+            entity_types = { target_type } | { entity_type for entity_type, _ in lookups }
+            target_id = self.resolve(target_type, target)
+            principal_ids = [self.resolve(entity_type, name) for entity_type, name in lookups]
+            if target_id is None or None in principal_ids:
+                return None, entity_types
+            return permission_update(target_type, target_id, self.permissions(grants, principal_ids)), entity_types
+
+        def send(updates):
+            requests[0] += 1
+            return update_permissions_batch(self.access_token, updates, len(updates), self.transport)
+
+        results = self.resolver.send_with_fresh_ids(targets, build, send)
+        return results, requests[0]
+
+def describe_grant(grant):
+    principal = "all workspace members" if grant['principal_type'] == "anyone" else f"{grant['principal_type']} '{grant['principal']}'"
+    return f"{principal} on {grant['target_type']} '{grant['target']}'"
+
+def error_messages(errors):
+    return "; ".join(error.get('message', str(error)) for error in errors)
+
+def run_batch(runner, numbered_rows, concurrency, updates_per_request=DEFAULT_UPDATES_PER_REQUEST, journal=None):
+    # Returns (line number, grant, succeeded, message) for every row of the batch in manifest order, and the number of requests sent.
+    # With a journal, the rows of every request are recorded as soon as it succeeds.
+    results = {}
+    targets = {}
+    for line_number, row in numbered_rows:
+        try:
+            grant = normalize_row(row)
+        except (ValueError, AttributeError) as error:
+            results[line_number] = (None, False, str(error))
+            continue
+        message = runner.missing(grant)
+        results[line_number] = (grant, False, message)
+        if message is None:
+            targets.setdefault((grant['target_type'], grant['target']), []).append(line_number)
+
+    # Updates for up to updates_per_request targets are packed into each request
+    target_list = [(target_type, target, [results[line_number][0] for line_number in line_numbers]) for (target_type, target), line_numbers in targets.items()]
+    chunks = [target_list[start:start + updates_per_request] for start in range(0, len(target_list), updates_per_request)]
+    requests_sent = 0
+    for chunk, (chunk_results, chunk_requests) in run_ordered(runner.apply_targets, chunks, concurrency):
+        requests_sent += chunk_requests
+        applied = []
+        for (target_type, target, _), (added, errors) in zip(chunk, chunk_results):
+            for line_number in targets[(target_type, target)]:
+                grant = results[line_number][0]
+                if added:
+                    applied.append(line_number)
+                    results[line_number] = (grant, True, f"{ 'Write' if grant['can_modify'] else 'Read' } permission added successfully.")
+                else:
+                    results[line_number] = (grant, False, f"Failed to add permission: {error_messages(errors)}")
+        if journal is not None:
+            journal.record(applied)
+    return [(line_number,) + results[line_number] for line_number in sorted(results)], requests_sent
+
+def run_manifest(runner, rows, concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE, updates_per_request=DEFAULT_UPDATES_PER_REQUEST, journal=None):
+    # Apply the rows a batch at a time, coalescing grants per target, and print every result in manifest order.
+    # Rows the journal lists as applied by an earlier run are skipped.
+    summary = {"total": 0, "succeeded": 0, "failed": 0, "invalid": 0, "skipped": 0, "requests": 0}
+    start = time.monotonic()
+    numbered_rows = enumerate(rows, start=1)
+    if journal is not None:
+        numbered_rows = skip_completed(numbered_rows, journal, summary)
+    while True:
+        batch = list(islice(numbered_rows, batch_size))
+        if not batch:
+            break
+        results, requests_sent = run_batch(runner, batch, concurrency, updates_per_request, journal)
+        summary['requests'] += requests_sent
+        for line_number, grant, succeeded, message in results:
+            summary['total'] += 1
+            if grant is None:
+                summary['invalid'] += 1
+                print(f"[{line_number}] Invalid row: {message}")
+                continue
+            summary['succeeded' if succeeded else 'failed'] += 1
+            print(f"[{line_number}] {'OK' if succeeded else 'FAILED'} {describe_grant(grant)}: {message}")
+    summary['elapsed'] = time.monotonic() - start
+    return summary
+
+def skip_completed(numbered_rows, journal, summary):
+    for line_number, row in numbered_rows:
+        if line_number in journal.completed:
+            summary['skipped'] += 1
+        else:
+            yield line_number, row
+
+def print_summary(summary):
+    elapsed = summary['elapsed']
+    rate = summary['total'] / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {summary['total']} rows in {elapsed:.2f}s ({rate:.1f} rows/s): "
+          f"{summary['succeeded']} succeeded, {summary['failed']} failed, {summary['invalid']} invalid, "
+          f"{summary['requests']} update requests sent."
+          + (f" {summary['skipped']} rows skipped as already applied." if summary['skipped'] else ""))
+
+def main():
+    # Load all the relevant environment and command line options
+    options = Options()
+
+    # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+    token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                 client_credentials=options.client_credentials, persist=options.token_cache)
+    access_token = None
+    try:
+        access_token = token_manager.access_token()
+    except:
+        access_token = None
+
+    # Validate the access token
+    if (access_token is None):
+        print("Unable to retrieve access token.")
+        exit()
+
+    # Validate the workspace
+    workspace_error = single_workspace(options.workspace)
+    if workspace_error is not None:
+        print(workspace_error)
+        exit()
+    print(f"Workspace URL: {options.workspace}")
+
+    # Apply the manifest
+    id_cache = IdCache(options.cache_path, options.cache_ttl) if options.cache else None
+    metrics = RequestMetrics() if options.profile else None
+    transport = GraphQLTransport(pool_size=max(options.pool_size, options.concurrency), timeout=(10, options.timeout),
+                                 rate_limiter=TokenBucket(options.rate_limit), token_source=token_manager, metrics=metrics)
+    runner = BulkRunner(access_token, options.workspace, id_cache, transport, options.page_size)
+    if options.refresh_cache:
+        runner.resolver.invalidate()
+    journal = None
+    if options.checkpoint is not None:
+        try:
+            journal = CheckpointJournal(options.checkpoint, file_fingerprint(options.manifest), options.workspace)
+        except ValueError as error:
+            print(error)
+            exit()
+        if journal.completed:
+            print(f"Resuming from '{options.checkpoint}': {len(journal.completed)} rows already applied.")
+    try:
+        summary = run_manifest(runner, read_manifest(options.manifest, options.format), options.concurrency, options.batch_size,
+                               options.updates_per_request, journal)
+    except (GraphQLError, requests.RequestException) as error:
+        # Requests are retried before getting here, so the API or the network is down; applied rows are already in the journal
+        print(f"Stopped: {error}")
+        if journal is not None:
+            print(f"Run again with --checkpoint '{options.checkpoint}' to resume.")
+        report(metrics, options.profile_output)
+        transport.close()
+        exit(1)
+    print_summary(summary)
+    report(metrics, options.profile_output)
+    transport.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+
+# Append-only record of the manifest rows that have been applied, so an interrupted run can resume
+# without sending the completed updates again. The first line identifies the manifest and workspace the
+# journal belongs to; every other line is one completed row. Each write is flushed to disk before returning.
+class CheckpointJournal:
+    def __init__(self, path, manifest_fingerprint, workspace_url):
+        self.path = path
+        self.completed = set()
+        header = { "manifest": manifest_fingerprint, "workspace": workspace_url }
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path) as journal:
+                contents = journal.read()
+            lines = contents.splitlines()
+            if json.loads(lines[0]) != header:
+                raise ValueError(f"The checkpoint '{path}' was written for a different manifest or workspace")
+            for line in lines[1:]:
+                try:
+                    self.completed.add(json.loads(line)['line'])
+                except (ValueError, KeyError, TypeError):
+                    # The last line may have been cut short when the previous run was killed
+                    continue
+            if not contents.endswith("\n"):
+                # Terminate the line cut short so the next entry starts on its own line
+                self.write([], prefix="\n")
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.write([header])
+
+    def record(self, line_numbers):
+        line_numbers = [line_number for line_number in line_numbers if line_number not in self.completed]
+        if line_numbers:
+            self.write([{ "line": line_number } for line_number in line_numbers])
+            self.completed.update(line_numbers)
+
+    def write(self, entries, prefix=""):
+        with open(self.path, 'a') as journal:
+            journal.write(prefix)
+            for entry in entries:
+                journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as contents:
+        for chunk in iter(lambda: contents.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
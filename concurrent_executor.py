@@ -0,0 +1,72 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 4
+
+def run_ordered(func, items, concurrency=DEFAULT_CONCURRENCY):
+    # Call func on every item using up to `concurrency` threads and yield (item, result) pairs in the order of items.
+    # Only a bounded window of items is in flight at once, so items can be a stream of any length.
+    if concurrency <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= concurrency * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def run_all(funcs, concurrency=DEFAULT_CONCURRENCY):
+    # Call every function without arguments concurrently and return their results in order
+    return [result for _, result in run_ordered(lambda func: func(), funcs, concurrency)]
+
+def iter_prefetched(items, buffer_size):
+    # Start reading items on a background thread right away, staying at most buffer_size items ahead of the caller,
+    # so a stream of API pages keeps downloading while the items already received are processed.
+    # Errors raised while reading are raised to the caller in their place in the stream.
+    buffer = queue.Queue(maxsize=max(1, buffer_size))
+    stopped = threading.Event()
+    end = object()
+
+    def put(entry):
+        # Gives up when the caller stopped reading, so the thread doesn't wait forever on a full buffer
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as error:
+            put((end, error))
+            return
+        put((end, None))
+
+    threading.Thread(target=read, daemon=True).start()
+
+    def consume():
+        try:
+            while True:
+                item, error = buffer.get()
+                if item is end:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stopped.set()
+
+    return consume()
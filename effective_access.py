@@ -0,0 +1,361 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import os
+import time
+import dotenv
+from graphql_actions import iter_groups_with_members, iter_users, iter_folders_with_permissions, iter_projects_with_permissions, is_validation_error
+from graphql_actions import GraphQLTransport, GraphQLError, DEFAULT_POOL_SIZE, DEFAULT_PAGE_SIZE
+from concurrent_executor import run_all, DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from id_cache import cache_key
+from token_manager import TokenManager
+from request_metrics import RequestMetrics, report
+from workspace_fanout import single_workspace
+
+DEFAULT_SNAPSHOT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'nexar_permissions', 'graphs')
+DEFAULT_SNAPSHOT_TTL = 60 * 60
+SNAPSHOT_VERSION = 1
+# Grants are stored as (kind, principal index, can_modify); ANYONE grants have no principal
+ANYONE, GROUP, USER = 0, 1, 2
+ACCESS_LEVELS = { None: "none", False: "read", True: "write" }
+
+class Options:
+    def __init__(self):
+        # Load the environment variables from the .env file
+        dotenv.load_dotenv()
+
+        # These options can only come from the environment or the .env file
+        self.client_id = os.getenv('NEXAR_CLIENT_ID')
+        self.client_secret = os.getenv('NEXAR_CLIENT_SECRET')
+
+        # The scopes are set to the required scopes for this script
+        self.scopes = ["user.access", "design.domain"]
+
+        parsed_args = self.parse_args()
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Request timings are only collected when asked to
+        self.profile = parsed_args.profile or parsed_args.profile_output is not None
+        self.profile_output = parsed_args.profile_output
+
+        # Workspace can be passed via an argument, an environment variable, or the .env file
+        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # What to look up
+        self.users = parsed_args.user or []
+        self.folders = parsed_args.folder or []
+        self.projects = parsed_args.project or []
+        self.checks = parsed_args.checks
+
+        # The graph is reloaded from the snapshot while it is younger than the TTL
+        self.snapshot_directory = parsed_args.snapshot_directory
+        self.snapshot_ttl = parsed_args.snapshot_ttl
+        self.refresh = parsed_args.refresh
+
+        # Connection settings for the API
+        self.pool_size = parsed_args.pool_size
+        self.timeout = parsed_args.timeout
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Show who can access folders and projects, and what users can access, including access through groups')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('-u', '--user', help='Show what the user with this EMAIL can access (can be repeated)', action='append')
+        args.add_argument('-f', '--folder', help='Show who can access the folder at this PATH (can be repeated)', action='append')
+        args.add_argument('-p', '--project', help='Show who can access the project with this NAME (can be repeated)', action='append')
+        args.add_argument('--checks', help='Check the access of every row of this CSV or JSONL file with user, target_type and target fields')
+        args.add_argument('--snapshot-directory', help='The directory where the permission graph of each workspace is saved', default=DEFAULT_SNAPSHOT_DIRECTORY)
+        args.add_argument('--snapshot-ttl', help='The number of seconds a saved permission graph is reused', type=int, default=DEFAULT_SNAPSHOT_TTL)
+        args.add_argument('--refresh', help='Load the permission graph from the API even when a recent snapshot exists', action='store_true')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--timeout', help='The number of seconds to wait for each API response', type=float, default=120)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        args.add_argument('--profile', help='Print the time, size and retries of the API requests by operation at the end of the run', action='store_true')
+        args.add_argument('--profile-output', help='Also write every API request to this file as JSON lines (or Prometheus metrics for a .prom file)')
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
+        return args.parse_args()
+
+# The users, groups, folders and projects of a workspace and the permissions between them.
+# Every entity is stored once in a list and referred to by its position, and the grants of each target are
+# indexed by principal, so checking one user on one target costs a dict lookup per group of the user and
+# listing what a user can access only visits the grants of that user, their groups and everyone.
+# memberships is None when the API didn't return group members; access through groups is then unknown.
+class PermissionGraph:
+    def __init__(self, workspace_url, users, groups, targets, grants, memberships, loaded_at=None):
+        # users: [(user ID, email)], groups: [(group ID, name)], targets: [(target type, name, target ID)],
+        # grants: [[(kind, principal index, can_modify)] for each target], memberships: [[user index] for each group]
+        self.workspace_url = workspace_url
+        self.users = users
+        self.groups = groups
+        self.targets = targets
+        self.grants = grants
+        self.memberships = memberships
+        self.loaded_at = loaded_at if loaded_at is not None else time.time()
+        self.user_index = { email.lower(): index for index, (_, email) in enumerate(users) }
+        self.target_index = { (target_type, name): index for index, (target_type, name, _) in enumerate(targets) }
+        self.user_groups = [[] for _ in users]
+        for group_index, members in enumerate(memberships or []):
+            for user_index in members:
+                self.user_groups[user_index].append(group_index)
+        self.target_grants = [{ (kind, principal): can_modify for kind, principal, can_modify in target_grants } for target_grants in grants]
+        self.grants_by_principal = {}
+        for target_index, target_grants in enumerate(grants):
+            for kind, principal, can_modify in target_grants:
+                self.grants_by_principal.setdefault((kind, principal), []).append((target_index, can_modify))
+        self.user_access_cache = {}
+
+    def find_user(self, email):
+        return self.user_index.get(email.lower())
+
+    def find_target(self, target_type, name):
+        return self.target_index.get((target_type, name))
+
+    def access(self, user_index, target_index):
+        # True for write access, False for read access, None for no access
+        target_grants = self.target_grants[target_index]
+        level = None
+        for key in [(ANYONE, None), (USER, user_index)] + [(GROUP, group_index) for group_index in self.user_groups[user_index]]:
+            can_modify = target_grants.get(key)
+            if can_modify is not None:
+                level = level or can_modify
+                if level:
+                    return True
+        return level
+
+    def user_access(self, user_index):
+        # {target index: can_modify} for every target the user can access; kept for repeated queries about the same user
+        access = self.user_access_cache.get(user_index)
+        if access is None:
+            access = {}
+            for key in [(ANYONE, None), (USER, user_index)] + [(GROUP, group_index) for group_index in self.user_groups[user_index]]:
+                for target_index, can_modify in self.grants_by_principal.get(key, []):
+                    access[target_index] = access.get(target_index, False) or can_modify
+            self.user_access_cache[user_index] = access
+        return access
+
+    def target_access(self, target_index):
+        # {user index: (can_modify, [how the access is granted])} for every user who can access the target
+        access = {}
+        def grant(user_index, can_modify, source):
+            current, sources = access.get(user_index, (False, []))
+            access[user_index] = (current or can_modify, sources + [source])
+        for (kind, principal), can_modify in self.target_grants[target_index].items():
+            if kind == ANYONE:
+                for user_index in range(len(self.users)):
+                    grant(user_index, can_modify, "everyone")
+            elif kind == USER:
+                grant(principal, can_modify, "directly")
+            elif self.memberships is not None:
+                for user_index in self.memberships[principal]:
+                    grant(user_index, can_modify, f"group '{self.groups[principal][1]}'")
+        return access
+
+    def to_json(self):
+        return {
+            "version": SNAPSHOT_VERSION,
+            "workspace": cache_key(self.workspace_url),
+            "loaded_at": self.loaded_at,
+            "users": self.users,
+            "groups": self.groups,
+            "targets": self.targets,
+            "grants": self.grants,
+            "memberships": self.memberships
+        }
+
+    @classmethod
+    def from_json(cls, workspace_url, data):
+        return cls(workspace_url, [tuple(user) for user in data['users']], [tuple(group) for group in data['groups']],
+                   [tuple(target) for target in data['targets']], [[tuple(grant) for grant in target_grants] for target_grants in data['grants']],
+                   data['memberships'], data['loaded_at'])
+
+def load_graph(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    # Download the groups with their members, the users and the permissions of every folder and project at the same time
+    def groups_with_members():
+        try:
+            return list(iter_groups_with_members(access_token, workspace_url, transport))
+        except GraphQLError as error:
+            if not is_validation_error(error):
+                raise
+            return None
+    group_list, user_list, folder_list, project_list = run_all([
+        groups_with_members,
+        lambda: list(iter_users(access_token, workspace_url, transport)),
+        lambda: list(iter_folders_with_permissions(access_token, workspace_url, transport)),
+        lambda: list(iter_projects_with_permissions(access_token, workspace_url, transport=transport, page_size=page_size))
+    ], concurrency)
+    if group_list is None:
+        print("Group members are not available from the API; access through groups is not included.")
+
+    users = [(user['userId'], user['email']) for user in user_list if user['email']]
+    user_positions = { user_id: index for index, (user_id, _) in enumerate(users) }
+    groups = [(group['id'], group['name']) for group in group_list or []]
+    group_positions = { group_id: index for index, (group_id, _) in enumerate(groups) }
+    memberships = None
+    if group_list is not None:
+        memberships = [[user_positions[member['userId']] for member in group.get('users') or [] if member.get('userId') in user_positions]
+                       for group in group_list]
+
+    targets = []
+    grants = []
+    for target_type, name_field, target_list in [("folder", 'path', folder_list), ("project", 'name', project_list)]:
+        for target in target_list:
+            targets.append((target_type, target[name_field], target['id']))
+            target_grants = []
+            for permission in target.get('permissions') or []:
+                can_modify = bool(permission.get('canModify'))
+                if permission.get('scope') == "ANYONE":
+                    target_grants.append((ANYONE, None, can_modify))
+                elif permission.get('scope') == "GROUP" and permission.get('groupId') in group_positions:
+                    target_grants.append((GROUP, group_positions[permission['groupId']], can_modify))
+                elif permission.get('scope') == "USER" and permission.get('userId') in user_positions:
+                    target_grants.append((USER, user_positions[permission['userId']], can_modify))
+            grants.append(target_grants)
+    return PermissionGraph(workspace_url, users, groups, targets, grants, memberships)
+
+def snapshot_path(directory, workspace_url):
+    return os.path.join(directory, hashlib.sha256(cache_key(workspace_url).encode()).hexdigest()[:16] + '.json.gz')
+
+def save_snapshot(graph, path):
+    # Written to a temporary file first so a reader never sees half a snapshot. The snapshot holds every user's email
+    # and access, so like the token file it is only readable by its owner
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    temporary_path = path + '.tmp'
+    if os.path.exists(temporary_path):
+        # A leftover from an interrupted run keeps its permissions when opened again
+        os.remove(temporary_path)
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as snapshot_file, gzip.open(snapshot_file, 'wt') as snapshot:
+        json.dump(graph.to_json(), snapshot, separators=(',', ':'))
+    os.replace(temporary_path, path)
+
+def load_snapshot(path, workspace_url, ttl):
+    # Returns None when there is no usable snapshot for the workspace younger than the TTL
+    try:
+        with gzip.open(path, 'rt') as snapshot:
+            data = json.load(snapshot)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != SNAPSHOT_VERSION or data.get('workspace') != cache_key(workspace_url) or time.time() - data['loaded_at'] > ttl:
+        return None
+    return PermissionGraph.from_json(workspace_url, data)
+
+def read_checks(path):
+    # The same CSV or JSONL layout as a manifest, with a user column instead of the principal
+    with open(path, newline='') as checks:
+        if os.path.splitext(path)[1].lower() in ['.jsonl', '.ndjson']:
+            return [json.loads(line) for line in checks if line.strip()]
+        return list(csv.DictReader(checks))
+
+def describe_target(graph, target_index):
+    target_type, name, _ = graph.targets[target_index]
+    return f"{target_type} '{name}'"
+
+def print_user_access(graph, email):
+    user_index = graph.find_user(email)
+    if user_index is None:
+        print(f"User '{email}' not found.")
+        return
+    access = graph.user_access(user_index)
+    print(f"User '{email}' can access {len(access)} folders and projects:")
+    for target_index in sorted(access, key=lambda index: graph.targets[index][:2]):
+        print(f"  {ACCESS_LEVELS[access[target_index]]:<5} {describe_target(graph, target_index)}")
+
+def print_target_access(graph, target_type, name):
+    target_index = graph.find_target(target_type, name)
+    if target_index is None:
+        print(f"{target_type.capitalize()} '{name}' not found.")
+        return
+    access = graph.target_access(target_index)
+    print(f"{len(access)} users can access {target_type} '{name}':")
+    for user_index in sorted(access, key=lambda index: graph.users[index][1].lower()):
+        can_modify, sources = access[user_index]
+        print(f"  {ACCESS_LEVELS[can_modify]:<5} {graph.users[user_index][1]} ({', '.join(sources)})")
+
+def run_checks(graph, rows):
+    # Prints the access of every row and returns the number of checks and the seconds spent answering them
+    elapsed = 0.0
+    for line_number, row in enumerate(rows, start=1):
+        email = str(row.get('user') or '')
+        target_type = str(row.get('target_type') or '').strip().lower()
+        target = row.get('target')
+        start = time.perf_counter()
+        user_index = graph.find_user(email)
+        target_index = graph.find_target(target_type, target)
+        level = graph.access(user_index, target_index) if user_index is not None and target_index is not None else None
+        elapsed += time.perf_counter() - start
+        if user_index is None:
+            print(f"[{line_number}] User '{email}' not found.")
+        elif target_index is None:
+            print(f"[{line_number}] {target_type.capitalize()} '{target}' not found.")
+        else:
+            print(f"[{line_number}] {email} {ACCESS_LEVELS[level]} {target_type} '{target}'")
+    return len(rows), elapsed
+
+def main():
+    # Load all the relevant environment and command line options
+    options = Options()
+
+    # Validate the workspace
+    workspace_error = single_workspace(options.workspace)
+    if workspace_error is not None:
+        print(workspace_error)
+        exit()
+    print(f"Workspace URL: {options.workspace}")
+
+    # Reuse the saved graph while it is recent enough, otherwise load it from the API
+    path = snapshot_path(options.snapshot_directory, options.workspace)
+    graph = None if options.refresh else load_snapshot(path, options.workspace, options.snapshot_ttl)
+    metrics = None
+    if graph is not None:
+        print(f"Loaded the permission graph saved {time.time() - graph.loaded_at:.0f}s ago.")
+    else:
+        # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+        token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                     client_credentials=options.client_credentials, persist=options.token_cache)
+        access_token = None
+        try:
+            access_token = token_manager.access_token()
+        except:
+            access_token = None
+
+        # Validate the access token
+        if (access_token is None):
+            print("Unable to retrieve access token.")
+            exit()
+
+        metrics = RequestMetrics() if options.profile else None
+        transport = GraphQLTransport(pool_size=max(options.pool_size, options.concurrency), timeout=(10, options.timeout),
+                                     rate_limiter=TokenBucket(options.rate_limit), token_source=token_manager, metrics=metrics)
+        start = time.monotonic()
+        graph = load_graph(access_token, options.workspace, transport, options.page_size, options.concurrency)
+        transport.close()
+        save_snapshot(graph, path)
+        print(f"Loaded {len(graph.users)} users, {len(graph.groups)} groups and {len(graph.targets)} folders and projects in {time.monotonic() - start:.2f}s.")
+
+    for email in options.users:
+        print_user_access(graph, email)
+    for target_type, names in [("folder", options.folders), ("project", options.projects)]:
+        for name in names:
+            print_target_access(graph, target_type, name)
+    if options.checks is not None:
+        count, elapsed = run_checks(graph, read_checks(options.checks))
+        if count:
+            print(f"Answered {count} checks in {elapsed * 1000:.1f} ms ({elapsed / count * 1000:.4f} ms per check).")
+    report(metrics, options.profile_output)
+
+if __name__ == "__main__":
+    main()
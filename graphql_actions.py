@@ -1,7 +1,51 @@
-import requests
 import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import is_throttled, is_retryable, retry_delay, json_body
+from concurrent_executor import run_ordered
+from request_metrics import operation_name
+
+GRAPHQL_ENDPOINT = 'https://api.nexar.com/graphql'
+DEFAULT_POOL_SIZE = 10
+# Seconds to wait for the connection and for the response
+DEFAULT_TIMEOUT = (10, 120)
+# Number of times a request is retried after a network error, throttling or a transient error
+DEFAULT_RETRIES = 5
+# Network errors after which a request is sent again
+RETRYABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+# Number of permission updates packed into one GraphQL document by update_permissions_batch
+DEFAULT_UPDATES_PER_REQUEST = 50
+# Number of projects requested per page of desProjects
+DEFAULT_PAGE_SIZE = 100
+
+# Raised when a query fails even after retrying, instead of a KeyError on the missing data
+class GraphQLError(Exception):
+    def __init__(self, message, errors=None, status_code=None):
+        super().__init__(message)
+        self.errors = errors or []
+        self.status_code = status_code
 
-def get_group_id(access_token, workspace_url, group_name):
+def response_body(response):
+    # The parsed JSON body, or an empty one when the response isn't JSON (such as an error page from a proxy)
+    return json_body(response)
+
+def response_data(response):
+    # The data of a successful query; raises GraphQLError when the request failed or a field couldn't be resolved
+    body = response_body(response)
+    data = body.get('data')
+    if response.status_code != 200 or not data or any(value is None for value in data.values()):
+        errors = body.get('errors') or []
+        messages = "; ".join(error.get('message', str(error)) for error in errors) or "no data returned"
+        raise GraphQLError(f"GraphQL request failed (HTTP {response.status_code}): {messages}", errors, response.status_code)
+    return data
+
+def mutation_result(response, field):
+    # The result of a mutation field, or an empty dict when it failed
+    return (response_body(response).get('data') or {}).get(field) or {}
+
+def iter_groups(access_token, workspace_url, transport=None):
     query = '''
     query GetGroups($workspaceUrl: String!) {
         desTeam(workspaceUrl: $workspaceUrl) {
@@ -15,15 +59,49 @@ def get_group_id(access_token, workspace_url, group_name):
     variables = {
         "workspaceUrl": workspace_url
     }
-    response = send_graphql_request(query, variables, access_token)
-    for group in response.json()['data']['desTeam']['groups']:
+    # The API returns the whole list in one response, so there is nothing to page through
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    yield from response_data(response)['desTeam']['groups']
+
+def get_groups(access_token, workspace_url, transport=None):
+    return list(iter_groups(access_token, workspace_url, transport))
+
+def get_group_id(access_token, workspace_url, group_name, transport=None):
+    try:
+        return find_id(access_token, workspace_url, "group", group_name, transport)
+    except FilterUnsupported:
+        pass
+    for group in iter_groups(access_token, workspace_url, transport):
         if group['name'] == group_name:
             return group['id']
     return None
 
-def get_user_id(access_token, workspace_url, user_email):
+def iter_groups_with_members(access_token, workspace_url, transport=None):
     query = '''
-    query GetGroups($workspaceUrl: String!) {
+    query GetGroupMembers($workspaceUrl: String!) {
+        desTeam(workspaceUrl: $workspaceUrl) {
+            groups {
+                id
+                name
+                users {
+                    userId
+                }
+            }
+        }
+    }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    yield from response_data(response)['desTeam']['groups']
+
+def get_groups_with_members(access_token, workspace_url, transport=None):
+    return list(iter_groups_with_members(access_token, workspace_url, transport))
+
+def iter_users(access_token, workspace_url, transport=None):
+    query = '''
+    query GetUsers($workspaceUrl: String!) {
         desTeam(workspaceUrl: $workspaceUrl) {
             users {
                 userId
@@ -35,33 +113,70 @@ def get_user_id(access_token, workspace_url, user_email):
     variables = {
         "workspaceUrl": workspace_url
     }
-    response = send_graphql_request(query, variables, access_token)
-    for user in response.json()['data']['desTeam']['users']:
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    yield from response_data(response)['desTeam']['users']
+
+def get_users(access_token, workspace_url, transport=None):
+    return list(iter_users(access_token, workspace_url, transport))
+
+def get_user_id(access_token, workspace_url, user_email, transport=None):
+    try:
+        return find_id(access_token, workspace_url, "user", user_email, transport)
+    except FilterUnsupported:
+        pass
+    for user in iter_users(access_token, workspace_url, transport):
         if user['email'] == user_email:
             return user['userId']
     return None
 
-def get_project_id(access_token, workspace_url, project_name):
+def iter_project_pages(query, variables, access_token, page_size=DEFAULT_PAGE_SIZE, transport=None):
+    # Follow the desProjects cursor one page at a time, yielding the projects of each page as it arrives
+    after = None
+    while True:
+        page_variables = dict(variables, first=page_size, after=after)
+        response = send_graphql_request(query, page_variables, access_token, transport=transport)
+        projects = response_data(response)['desProjects']
+        yield from projects['nodes']
+        page_info = projects.get('pageInfo') or {}
+        if not page_info.get('hasNextPage') or not page_info.get('endCursor'):
+            return
+        after = page_info['endCursor']
+
+def iter_projects(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
     query = '''
-        query GetProjects($workspaceUrl: String!) {
-            desProjects(workspaceUrl: $workspaceUrl) {
+        query GetProjects($workspaceUrl: String!, $first: Int!, $after: String) {
+            desProjects(workspaceUrl: $workspaceUrl, first: $first, after: $after) {
                 nodes {
                     id
                     name
                 }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
             }
         }
     '''
     variables = {
         "workspaceUrl": workspace_url
     }
-    response = send_graphql_request(query, variables, access_token)
-    for project in response.json()['data']['desProjects']['nodes']:
+    yield from iter_project_pages(query, variables, access_token, page_size, transport)
+
+def get_projects(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
+    return list(iter_projects(access_token, workspace_url, transport=transport, page_size=page_size))
+
+def get_project_id(access_token, workspace_url, project_name, transport=None):
+    try:
+        return find_id(access_token, workspace_url, "project", project_name, transport)
+    except FilterUnsupported:
+        pass
+    # Stops fetching pages as soon as the project is found
+    for project in iter_projects(access_token, workspace_url, transport=transport):
         if project['name'] == project_name:
             return project['id']
     return None
 
-def get_folder_id(access_token, workspace_url, folder_path):
+def iter_folders(access_token, workspace_url, transport=None):
     query = '''
         query GetFolders($workspaceUrl: String!) {
             desLibrary(workspaceUrl: $workspaceUrl) {
@@ -75,13 +190,262 @@ def get_folder_id(access_token, workspace_url, folder_path):
     variables = {
         "workspaceUrl": workspace_url
     }
-    response = send_graphql_request(query, variables, access_token)
-    for folder in response.json()['data']['desLibrary']['folders']:
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    yield from response_data(response)['desLibrary']['folders']
+
+def get_folders(access_token, workspace_url, transport=None):
+    return list(iter_folders(access_token, workspace_url, transport))
+
+def get_folder_id(access_token, workspace_url, folder_path, transport=None):
+    try:
+        return find_id(access_token, workspace_url, "folder", folder_path, transport)
+    except FilterUnsupported:
+        pass
+    for folder in iter_folders(access_token, workspace_url, transport):
         if folder['path'] == folder_path:
             return folder['id']
     return None
 
-def add_group_permission_to_folder(access_token, folder_id, group_id, read_only=False):
+# Single-name lookups with a server-side filter, so only the matching entry is sent back instead of the whole list.
+# The filter arguments are not available on every deployment of the API; when one is rejected, it is remembered
+# for the rest of the process and find_id raises FilterUnsupported so the caller can fall back to the full list.
+FILTER_QUERIES = {
+    "group": ('''
+        query FindGroup($workspaceUrl: String!, $value: String!) {
+            desTeam(workspaceUrl: $workspaceUrl) {
+                groups(where: { name: { eq: $value } }) {
+                    id
+                }
+            }
+        }
+    ''', lambda data: [group['id'] for group in data['desTeam']['groups']]),
+    "user": ('''
+        query FindUser($workspaceUrl: String!, $value: String!) {
+            desTeam(workspaceUrl: $workspaceUrl) {
+                users(where: { email: { eq: $value } }) {
+                    userId
+                }
+            }
+        }
+    ''', lambda data: [user['userId'] for user in data['desTeam']['users']]),
+    "project": ('''
+        query FindProject($workspaceUrl: String!, $value: String!) {
+            desProjects(workspaceUrl: $workspaceUrl, first: 1, where: { name: { eq: $value } }) {
+                nodes {
+                    id
+                }
+            }
+        }
+    ''', lambda data: [project['id'] for project in data['desProjects']['nodes']]),
+    "folder": ('''
+        query FindFolder($workspaceUrl: String!, $value: String!) {
+            desLibrary(workspaceUrl: $workspaceUrl) {
+                folders(where: { path: { eq: $value } }) {
+                    id
+                }
+            }
+        }
+    ''', lambda data: [folder['id'] for folder in data['desLibrary']['folders']])
+}
+# Words in the errors returned for a document the schema doesn't accept
+VALIDATION_ERROR_WORDS = ["argument", "validation", "unknown field", "does not exist", "not defined"]
+
+unsupported_filters = set()
+
+class FilterUnsupported(Exception):
+    pass
+
+def find_id(access_token, workspace_url, entity_type, value, transport=None):
+    # Returns the ID of the entity whose name, email or path equals value, or None when there is none
+    if entity_type in unsupported_filters:
+        raise FilterUnsupported(entity_type)
+    query, ids = FILTER_QUERIES[entity_type]
+    variables = {
+        "workspaceUrl": workspace_url,
+        "value": value
+    }
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    try:
+        data = response_data(response)
+    except GraphQLError as error:
+        if not is_validation_error(error):
+            raise
+        unsupported_filters.add(entity_type)
+        raise FilterUnsupported(entity_type)
+    matches = ids(data)
+    return matches[0] if matches else None
+
+def is_validation_error(error):
+    if error.status_code == 400:
+        return True
+    for entry in error.errors:
+        code = str((entry.get('extensions') or {}).get('code', '')).lower()
+        message = str(entry.get('message', '')).lower()
+        if any(word in code or word in message for word in VALIDATION_ERROR_WORDS):
+            return True
+    return False
+
+def iter_folders_with_permissions(access_token, workspace_url, transport=None):
+    query = '''
+        query GetFolderPermissions($workspaceUrl: String!) {
+            desLibrary(workspaceUrl: $workspaceUrl) {
+                folders {
+                    id
+                    path
+                    permissions {
+                        canModify
+                        scope
+                        groupId
+                        userId
+                    }
+                }
+            }
+        }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    yield from response_data(response)['desLibrary']['folders']
+
+def get_folders_with_permissions(access_token, workspace_url, transport=None):
+    return list(iter_folders_with_permissions(access_token, workspace_url, transport))
+
+def iter_projects_with_permissions(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
+    query = '''
+        query GetProjectPermissions($workspaceUrl: String!, $first: Int!, $after: String) {
+            desProjects(workspaceUrl: $workspaceUrl, first: $first, after: $after) {
+                nodes {
+                    id
+                    name
+                    permissions {
+                        canModify
+                        scope
+                        groupId
+                        userId
+                    }
+                }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+            }
+        }
+    '''
+    variables = {
+        "workspaceUrl": workspace_url
+    }
+    yield from iter_project_pages(query, variables, access_token, page_size, transport)
+
+def get_projects_with_permissions(access_token, workspace_url, transport=None, page_size=DEFAULT_PAGE_SIZE):
+    return list(iter_projects_with_permissions(access_token, workspace_url, transport=transport, page_size=page_size))
+
+def permission_entry(principal_type, principal_id, can_modify):
+    # One entry of the permissions list accepted by desUpdateFolderPermissions and desUpdateProjectPermissions
+    if principal_type == "group":
+        return { "canModify": can_modify, "scope": "GROUP", "groupId": principal_id }
+    elif principal_type == "user":
+        return { "canModify": can_modify, "scope": "USER", "userId": principal_id }
+    elif principal_type == "anyone":
+        return { "canModify": can_modify, "scope": "ANYONE" }
+    raise ValueError(f"Unknown principal type '{principal_type}'")
+
+def unique_permissions(permissions):
+    # The same principal can only appear once per update; the last entry for a principal wins
+    entries = {}
+    for permission in permissions:
+        entries[(permission['scope'], permission.get('groupId'), permission.get('userId'))] = permission
+    return list(entries.values())
+
+def update_folder_permissions(access_token, folder_id, permissions, replace_existing=False, transport=None):
+    query = '''
+        mutation UpdateFolderPermissions($input: DesUpdateFolderPermissionsInput!) {
+            desUpdateFolderPermissions(input: $input) {
+                folderId
+            }
+        }
+    '''
+    variables = {
+        "input": {
+            "folderId": folder_id,
+            "replaceExisting": replace_existing,
+            "permissions": unique_permissions(permissions)
+        }
+    }
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    # Check if the response was successful, and the folder ID matches
+    if response.status_code == 200 and mutation_result(response, 'desUpdateFolderPermissions').get('folderId') == folder_id:
+        return True
+    else:
+        print(response_body(response).get('errors'))
+        return False
+
+def permission_update(target_type, target_id, permissions, replace_existing=False):
+    # One update for update_permissions_batch
+    return { "target_type": target_type, "target_id": target_id, "permissions": permissions, "replace_existing": replace_existing }
+
+def permission_updates_document(updates):
+    # Build one document holding every update under its own alias (update0, update1, ...)
+    arguments = []
+    fields = []
+    variables = {}
+    for index, update in enumerate(updates):
+        if update['target_type'] == "folder":
+            arguments.append(f"$input{index}: DesUpdateFolderPermissionsInput!")
+            fields.append(f"update{index}: desUpdateFolderPermissions(input: $input{index}) {{ folderId }}")
+            variables[f"input{index}"] = { "folderId": update['target_id'] }
+        elif update['target_type'] == "project":
+            arguments.append(f"$input{index}: DesUpdateProjectPermissionsInput!")
+            fields.append(f"update{index}: desUpdateProjectPermissions(input: $input{index}) {{ projectId }}")
+            variables[f"input{index}"] = { "projectId": update['target_id'] }
+        else:
+            raise ValueError(f"Unknown target type '{update['target_type']}'")
+        variables[f"input{index}"]["replaceExisting"] = update.get('replace_existing', False)
+        variables[f"input{index}"]["permissions"] = unique_permissions(update['permissions'])
+    query = "mutation UpdatePermissions(" + ", ".join(arguments) + ") {\n    " + "\n    ".join(fields) + "\n}"
+    return query, variables
+
+def update_permissions_batch(access_token, updates, max_per_request=DEFAULT_UPDATES_PER_REQUEST, transport=None, concurrency=1):
+    # Send many folder and project permission updates using as few requests as possible, up to concurrency requests at a time.
+    # Returns a (succeeded, errors) pair for every update, in the order of updates.
+    if not updates:
+        return []
+    max_per_request = max(1, max_per_request)
+    chunks = [updates[start:start + max_per_request] for start in range(0, len(updates), max_per_request)]
+    results = []
+    for _, chunk_results in run_ordered(lambda chunk: send_permission_updates(access_token, chunk, transport), chunks, concurrency):
+        results.extend(chunk_results)
+    return results
+
+def send_permission_updates(access_token, updates, transport=None):
+    # Send the updates as one document and match every result and error to its update
+    query, variables = permission_updates_document(updates)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    return permission_update_results(updates, response.status_code, response_body(response))
+
+def permission_update_results(updates, status_code, body):
+    # Returns a (succeeded, errors) pair for every update from the response to permission_updates_document
+    data = body.get('data') or {}
+    # Errors are matched to their update through the alias at the start of their path
+    errors = { index: [] for index in range(len(updates)) }
+    unmatched = []
+    for error in body.get('errors') or []:
+        alias = (error.get('path') or [None])[0]
+        if isinstance(alias, str) and alias.startswith("update") and alias[6:].isdigit() and int(alias[6:]) in errors:
+            errors[int(alias[6:])].append(error)
+        else:
+            unmatched.append(error)
+    results = []
+    for index, update in enumerate(updates):
+        id_field = "folderId" if update['target_type'] == "folder" else "projectId"
+        succeeded = status_code == 200 and (data.get(f"update{index}") or {}).get(id_field) == update['target_id']
+        update_errors = errors[index] if not succeeded else []
+        if not succeeded and not update_errors:
+            update_errors = unmatched if unmatched else [{ "message": f"HTTP {status_code}" }]
+        results.append((succeeded, update_errors))
+    return results
+
+def add_group_permission_to_folder(access_token, folder_id, group_id, read_only=False, transport=None):
     query = '''
         mutation AddGroupPermission($folder_id: ID!, $group_id: ID!, $can_modify: Boolean!) {
             desUpdateFolderPermissions(
@@ -105,17 +469,17 @@ def add_group_permission_to_folder(access_token, folder_id, group_id, read_only=
         "group_id": group_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the folder ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateFolderPermissions']['folderId'] == folder_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateFolderPermissions').get('folderId') == folder_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def add_user_permission_to_folder(access_token, folder_id, user_id, read_only=False):
+def add_user_permission_to_folder(access_token, folder_id, user_id, read_only=False, transport=None):
     query = '''
-        mutation AddGroupPermission($folder_id: ID!, $user_id: String!, $can_modify: Boolean!) {
+        mutation AddUserPermission($folder_id: ID!, $user_id: String!, $can_modify: Boolean!) {
             desUpdateFolderPermissions(
                 input: {
                 folderId: $folder_id
@@ -137,15 +501,15 @@ def add_user_permission_to_folder(access_token, folder_id, user_id, read_only=Fa
         "user_id": user_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the folder ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateFolderPermissions']['folderId'] == folder_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateFolderPermissions').get('folderId') == folder_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def add_anyone_permission_to_folder(access_token, folder_id, read_only=False):
+def add_anyone_permission_to_folder(access_token, folder_id, read_only=False, transport=None):
     query = '''
         mutation AddAnyonePermission($folder_id: ID!, $can_modify: Boolean!) {
             desUpdateFolderPermissions(
@@ -167,15 +531,15 @@ def add_anyone_permission_to_folder(access_token, folder_id, read_only=False):
         "folder_id": folder_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the folder ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateFolderPermissions']['folderId'] == folder_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateFolderPermissions').get('folderId') == folder_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
     
-def clear_all_permissions_on_folder(access_token, folder_id):
+def clear_all_permissions_on_folder(access_token, folder_id, transport=None):
     query = '''
         mutation ClearPermissions($folder_id: ID!) {
             desUpdateFolderPermissions(
@@ -192,14 +556,37 @@ def clear_all_permissions_on_folder(access_token, folder_id):
     variables = {
         "folder_id": folder_id
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     if response.status_code == 200:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def add_group_permission_to_project(access_token, project_id, group_id, read_only=False):
+def update_project_permissions(access_token, project_id, permissions, replace_existing=False, transport=None):
+    query = '''
+        mutation UpdateProjectPermissions($input: DesUpdateProjectPermissionsInput!) {
+            desUpdateProjectPermissions(input: $input) {
+                projectId
+            }
+        }
+    '''
+    variables = {
+        "input": {
+            "projectId": project_id,
+            "replaceExisting": replace_existing,
+            "permissions": unique_permissions(permissions)
+        }
+    }
+    response = send_graphql_request(query, variables, access_token, transport=transport)
+    # Check if the response was successful, and the project ID matches
+    if response.status_code == 200 and mutation_result(response, 'desUpdateProjectPermissions').get('projectId') == project_id:
+        return True
+    else:
+        print(response_body(response).get('errors'))
+        return False
+
+def add_group_permission_to_project(access_token, project_id, group_id, read_only=False, transport=None):
     query = '''
         mutation AddGroupPermission($project_id: ID!, $group_id: ID!, $can_modify: Boolean!) {
             desUpdateProjectPermissions(
@@ -223,17 +610,17 @@ def add_group_permission_to_project(access_token, project_id, group_id, read_onl
         "group_id": group_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the project ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateProjectPermissions']['projectId'] == project_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateProjectPermissions').get('projectId') == project_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def add_user_permission_to_project(access_token, project_id, user_id, read_only=False):
+def add_user_permission_to_project(access_token, project_id, user_id, read_only=False, transport=None):
     query = '''
-        mutation AddGroupPermission($project_id: ID!, $user_id: String!, $can_modify: Boolean!) {
+        mutation AddUserPermission($project_id: ID!, $user_id: String!, $can_modify: Boolean!) {
             desUpdateProjectPermissions(
                 input: {
                 projectId: $project_id
@@ -255,16 +642,16 @@ def add_user_permission_to_project(access_token, project_id, user_id, read_only=
         "user_id": user_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the project ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateProjectPermissions']['projectId'] == project_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateProjectPermissions').get('projectId') == project_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
 
-def add_anyone_permission_to_project(access_token, project_id, read_only=False):
+def add_anyone_permission_to_project(access_token, project_id, read_only=False, transport=None):
     query = '''
         mutation AddAnyonePermission($project_id: ID!, $can_modify: Boolean!) {
             desUpdateProjectPermissions(
@@ -286,15 +673,15 @@ def add_anyone_permission_to_project(access_token, project_id, read_only=False):
         "project_id": project_id,
         "can_modify": read_only
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     # Check if the response was successful, and the project ID matches
-    if response.status_code == 200 and response.json()['data']['desUpdateProjectPermissions']['projectId'] == project_id:
+    if response.status_code == 200 and mutation_result(response, 'desUpdateProjectPermissions').get('projectId') == project_id:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def clear_all_permissions_on_project(access_token, project_id):
+def clear_all_permissions_on_project(access_token, project_id, transport=None):
     query = '''
         mutation ClearPermissions($project_id: ID!) {
             desUpdateProjectPermissions(
@@ -311,15 +698,103 @@ def clear_all_permissions_on_project(access_token, project_id):
     variables = {
         "project_id": project_id
     }
-    response = send_graphql_request(query, variables, access_token)
+    response = send_graphql_request(query, variables, access_token, transport=transport)
     if response.status_code == 200:
         return True
     else:
-        print(response.json()['errors'])
+        print(response_body(response).get('errors'))
         return False
 
-def send_graphql_request(query, variables, access_token, graphql_endpoint = 'https://api.nexar.com/graphql'):
-    payload = { "query": query, "variables": variables }
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    response = requests.post(graphql_endpoint, data=json.dumps(payload), headers=headers, verify=True)
-    return response    
+# Reusable HTTP transport for GraphQL requests. The pooled session keeps connections to the API alive between
+# requests, so only the first request pays for the TCP and TLS handshakes.
+# With a rate limiter, every request first takes a token from it, and requests throttled by the API slow the limiter down.
+# Network errors, throttled requests and transient errors are retried after a jittered exponential backoff.
+# With a token source (such as a TokenManager), its current token is used instead of the access token passed in,
+# and a request rejected as unauthorized is retried once with a renewed token.
+# With a RequestMetrics, the time, size, status and retries of every call are recorded in it.
+class GraphQLTransport:
+    def __init__(self, graphql_endpoint=GRAPHQL_ENDPOINT, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, keep_alive=True,
+                 rate_limiter=None, retries=DEFAULT_RETRIES, token_source=None, metrics=None):
+        self.graphql_endpoint = graphql_endpoint
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.token_source = token_source
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Headers shared by every request are set once on the session; responses are gzip compressed by the server when possible
+        self.session.headers.update({'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def post(self, query, variables, access_token, graphql_endpoint=None):
+        endpoint = graphql_endpoint if graphql_endpoint is not None else self.graphql_endpoint
+        data = json.dumps({ "query": query, "variables": variables }).encode()
+        if self.metrics is None:
+            return self.send(endpoint, data, access_token)[0]
+        start = time.monotonic()
+        try:
+            response, retries = self.send(endpoint, data, access_token)
+        except Exception:
+            self.metrics.record(operation_name(query), time.monotonic() - start, len(data), 0, None, self.retries)
+            raise
+        self.metrics.record(operation_name(query), time.monotonic() - start, len(data), len(response.content), response.status_code, retries)
+        return response
+
+    def send(self, endpoint, data, access_token):
+        # Returns the final response and the number of times the request was sent again
+        if self.token_source is not None:
+            access_token = self.token_source.access_token()
+        headers = {'Authorization': 'Bearer ' + access_token}
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.post(endpoint, data=data, headers=headers, timeout=self.timeout, verify=True)
+            except RETRYABLE_EXCEPTIONS:
+                # Every request sent is safe to repeat: queries don't change anything and updates set the same permissions again
+                if attempt >= self.retries:
+                    raise
+                time.sleep(retry_delay(None, attempt))
+                attempt += 1
+                continue
+            if response.status_code == 401 and self.token_source is not None and not refreshed:
+                # The token expired or was revoked during the run
+                access_token = self.token_source.refresh(access_token)
+                headers = {'Authorization': 'Bearer ' + access_token}
+                refreshed = True
+                continue
+            if not is_retryable(response):
+                if self.rate_limiter is not None:
+                    self.rate_limiter.succeeded()
+                return response, attempt + refreshed
+            if self.rate_limiter is not None and is_throttled(response):
+                self.rate_limiter.throttled()
+            if attempt >= self.retries:
+                return response, attempt + refreshed
+            time.sleep(retry_delay(response, attempt))
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+
+default_transport = None
+default_transport_lock = threading.Lock()
+
+def get_default_transport():
+    # Shared by every call that is not given its own transport
+    global default_transport
+    with default_transport_lock:
+        if default_transport is None:
+            default_transport = GraphQLTransport()
+        return default_transport
+
+def send_graphql_request(query, variables, access_token, graphql_endpoint=None, transport=None):
+    if transport is None:
+        transport = get_default_transport()
+    return transport.post(query, variables, access_token, graphql_endpoint)
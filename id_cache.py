@@ -0,0 +1,63 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nexar_permissions', 'ids.sqlite')
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# On-disk cache of the name-to-ID indexes built by WorkspaceResolver, one entry per workspace and entity type.
+# A new connection is opened for every operation so the cache can be shared between threads and processes.
+class IdCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self.connect()) as connection, connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS indexes (
+                    workspace_url TEXT NOT NULL,
+                    entity_type TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    entries TEXT NOT NULL,
+                    PRIMARY KEY (workspace_url, entity_type)
+                )
+            ''')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, workspace_url, entity_type):
+        # Returns None when nothing is cached or the cached index is older than the TTL
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                'SELECT fetched_at, entries FROM indexes WHERE workspace_url = ? AND entity_type = ?',
+                (cache_key(workspace_url), entity_type)
+            ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def store(self, workspace_url, entity_type, entries):
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO indexes (workspace_url, entity_type, fetched_at, entries) VALUES (?, ?, ?, ?)',
+                (cache_key(workspace_url), entity_type, time.time(), json.dumps(entries))
+            )
+
+    def invalidate(self, workspace_url, entity_type=None):
+        with closing(self.connect()) as connection, connection:
+            if entity_type is None:
+                connection.execute('DELETE FROM indexes WHERE workspace_url = ?', (cache_key(workspace_url),))
+            else:
+                connection.execute(
+                    'DELETE FROM indexes WHERE workspace_url = ? AND entity_type = ?',
+                    (cache_key(workspace_url), entity_type)
+                )
+
+def cache_key(workspace_url):
+    # "https://x.365.altium.com" and "https://x.365.altium.com/" are the same workspace
+    return workspace_url.strip().rstrip('/').lower()
@@ -0,0 +1,251 @@
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from rate_limiter import TokenBucket
+
+DEFAULT_PORT = 8900
+MUTATION_FIELD_PATTERN = re.compile(r'(?:(\w+)\s*:\s*)?(desUpdate(?:Folder|Project)Permissions)\s*\(\s*input\s*:\s*(\$\w+|\{)')
+
+class Options:
+    def __init__(self):
+        parsed_args = self.parse_args()
+        self.host = parsed_args.host
+        self.port = parsed_args.port
+        self.groups = parsed_args.groups
+        self.users = parsed_args.users
+        self.folders = parsed_args.folders
+        self.projects = parsed_args.projects
+        self.latency = parsed_args.latency
+        self.jitter = parsed_args.jitter
+        self.throttle_rate = parsed_args.throttle_rate
+        self.filters = not parsed_args.no_filters
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Serve a local stand-in for the Nexar GraphQL API with a generated workspace')
+        args.add_argument('--host', help='The address to listen on', default='127.0.0.1')
+        args.add_argument('--port', help='The port to listen on', type=int, default=DEFAULT_PORT)
+        add_workspace_arguments(args)
+        return args.parse_args()
+
+def add_workspace_arguments(args):
+    # Shared with benchmark.py
+    args.add_argument('--groups', help='The number of groups in the workspace', type=int, default=100)
+    args.add_argument('--users', help='The number of users in the workspace', type=int, default=1000)
+    args.add_argument('--folders', help='The number of folders in the workspace', type=int, default=1000)
+    args.add_argument('--projects', help='The number of projects in the workspace', type=int, default=1000)
+    args.add_argument('--latency', help='The number of seconds added to every response', type=float, default=0.0)
+    args.add_argument('--jitter', help='The maximum number of random seconds added on top of the latency', type=float, default=0.0)
+    args.add_argument('--throttle-rate', help='Answer HTTP 429 to requests above this many per second (0 disables throttling)', type=float, default=0)
+    args.add_argument('--no-filters', help='Reject the where arguments of lookups, like a deployment without server-side filtering', action='store_true')
+
+# A generated workspace held in memory. Names follow a fixed pattern so scenarios can refer to them:
+# "Group 0", "user0@example.com", "Project 0", and folders "Folder 0", "Folder 0/Sub 0", ...
+# User N is a member of groups N and 7N (modulo the number of groups).
+class MockWorkspace:
+    def __init__(self, groups=100, users=1000, folders=1000, projects=1000):
+        self.groups = [{ "id": f"group-{index}", "name": f"Group {index}" } for index in range(groups)]
+        self.users = [{ "userId": f"user-{index}", "email": f"user{index}@example.com" } for index in range(users)]
+        self.folders = [{ "id": f"folder-{index}", "path": mock_folder_path(index) } for index in range(folders)]
+        self.projects = [{ "id": f"project-{index}", "name": f"Project {index}" } for index in range(projects)]
+        # Every user is a member of two groups
+        self.members = { group['id']: [] for group in self.groups }
+        for index, user in enumerate(self.users):
+            for group_index in { index % groups, index * 7 % groups } if groups else []:
+                self.members[f"group-{group_index}"].append({ "userId": user['userId'] })
+        self.permissions = {}
+        self.targets = { "folder": { folder['id'] for folder in self.folders }, "project": { project['id'] for project in self.projects } }
+        self.principals = { "GROUP": { group['id'] for group in self.groups }, "USER": { user['userId'] for user in self.users } }
+        self.lock = threading.Lock()
+
+    def with_permissions(self, items):
+        with self.lock:
+            return [dict(item, permissions=list(self.permissions.get(item['id'], []))) for item in items]
+
+    def update(self, target_type, target_id, permissions, replace_existing):
+        # Returns an error message, or None when the update was applied
+        if target_id not in self.targets[target_type]:
+            return f"The {target_type} '{target_id}' does not exist"
+        entries = []
+        for permission in permissions:
+            entry = { "canModify": bool(permission.get('canModify')), "scope": permission.get('scope'),
+                      "groupId": permission.get('groupId'), "userId": permission.get('userId') }
+            if entry['scope'] not in ["GROUP", "USER", "ANYONE"]:
+                return f"Invalid scope '{entry['scope']}'"
+            # Like the real API, a stale or made-up group or user ID fails the update
+            principal_id = entry['groupId'] if entry['scope'] == "GROUP" else entry['userId'] if entry['scope'] == "USER" else None
+            if entry['scope'] != "ANYONE" and principal_id not in self.principals[entry['scope']]:
+                return f"The {entry['scope'].lower()} '{principal_id}' does not exist"
+            entries.append(entry)
+        with self.lock:
+            current = {} if replace_existing else { mock_principal_key(entry): entry for entry in self.permissions.get(target_id, []) }
+            for entry in entries:
+                current[mock_principal_key(entry)] = entry
+            self.permissions[target_id] = list(current.values())
+        return None
+
+def mock_folder_path(index):
+    # Ten top-level folders with the other folders spread below them; every third one is nested in the folder before it
+    if index < 10:
+        return f"Folder {index}"
+    if index % 3 == 0:
+        return f"{mock_folder_path(index - 1)}/Part {index}"
+    return f"Folder {index % 10}/Sub {index}"
+
+def mock_principal_key(entry):
+    return (entry['scope'], entry.get('groupId'), entry.get('userId'))
+
+# Answers the queries and mutations sent by graphql_actions.py. The document is recognised by the fields it
+# selects rather than parsed, which is enough for the fixed set of operations the scripts send.
+class MockGraphQLHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like the real API
+    protocol_version = 'HTTP/1.1'
+    # Set on the subclass created by start_mock_server()
+    workspace = None
+    latency = 0.0
+    jitter = 0.0
+    throttle = None
+    filters = True
+    stats = None
+    stats_lock = None
+
+    def setup(self):
+        super().setup()
+        # Send the headers and the body without waiting for delayed ACKs, so the mock adds no latency of its own
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        self.count('requests')
+        if self.throttle is not None:
+            wait = self.throttle.try_acquire()
+            if wait > 0:
+                self.count('throttled')
+                self.send_json(429, { "errors": [{ "message": "Too many requests" }] }, { "Retry-After": f"{wait:.3f}" })
+                return
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if not str(self.headers.get('Authorization', '')).startswith('Bearer '):
+            self.send_json(401, { "errors": [{ "message": "Unauthorized" }] })
+            return
+        query = body.get('query') or ''
+        variables = body.get('variables') or {}
+        try:
+            result = self.execute(query, variables)
+        except (KeyError, ValueError, TypeError) as error:
+            result = { "data": None, "errors": [{ "message": f"Invalid request: {error}" }] }
+        self.send_json(200, result)
+
+    def execute(self, query, variables):
+        workspace = self.workspace
+        if query.lstrip().startswith('mutation'):
+            self.count('mutations')
+            return self.mutate(query, variables)
+        if 'where:' in query:
+            if not self.filters:
+                return { "errors": [{ "message": "The argument `where` does not exist.", "extensions": { "code": "HC0016" } }] }
+            self.count('filtered')
+        if 'desTeam' in query and 'groups' in query:
+            groups = filtered(query, variables, workspace.groups, 'name')
+            if re.search(r'groups\s*\{[^}]*users', query):
+                groups = [dict(group, users=workspace.members[group['id']]) for group in groups]
+            return { "data": { "desTeam": { "groups": groups } } }
+        if 'desTeam' in query and 'users' in query:
+            return { "data": { "desTeam": { "users": filtered(query, variables, workspace.users, 'email') } } }
+        if 'desLibrary' in query:
+            folders = workspace.with_permissions(workspace.folders) if 'permissions' in query else workspace.folders
+            return { "data": { "desLibrary": { "folders": filtered(query, variables, folders, 'path') } } }
+        if 'desProjects' in query:
+            projects = filtered(query, variables, workspace.projects, 'name')
+            start = int(variables.get('after') or 0)
+            end = start + int(variables.get('first') or 100)
+            nodes = projects[start:end]
+            if 'permissions' in query:
+                nodes = workspace.with_permissions(nodes)
+            has_next_page = end < len(projects)
+            return { "data": { "desProjects": { "nodes": nodes, "pageInfo": { "hasNextPage": has_next_page, "endCursor": str(end) if has_next_page else None } } } }
+        return { "data": None, "errors": [{ "message": "Unsupported query" }] }
+
+    def mutate(self, query, variables):
+        data = {}
+        errors = []
+        for alias, field, input_start in MUTATION_FIELD_PATTERN.findall(query):
+            target_type = "folder" if "Folder" in field else "project"
+            id_field = "folderId" if target_type == "folder" else "projectId"
+            if input_start.startswith('$'):
+                update = variables[input_start[1:]]
+            else:
+                update = inline_input(query, variables, id_field)
+            name = alias or field
+            error = self.workspace.update(target_type, update[id_field], update.get('permissions') or [], bool(update.get('replaceExisting')))
+            if error is None:
+                data[name] = { id_field: update[id_field] }
+            else:
+                data[name] = None
+                errors.append({ "message": error, "path": [name] })
+        return { "data": data, "errors": errors } if errors else { "data": data }
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def filtered(query, variables, items, field):
+    # Only equality filters on the looked-up field are sent by graphql_actions.find_id
+    if re.search(rf'where\s*:\s*\{{\s*{field}\s*:\s*\{{\s*eq\s*:\s*\$value', query):
+        return [item for item in items if item[field] == variables['value']]
+    return items
+
+def inline_input(query, variables, id_field):
+    # The add_*/clear_* mutations write the input inline with a single permission built from variables
+    target_id = variables.get('folder_id') if id_field == "folderId" else variables.get('project_id')
+    permissions = []
+    for scope in ["GROUP", "USER", "ANYONE"]:
+        if re.search(rf'scope\s*:\s*{scope}\b', query):
+            permissions.append({ "canModify": variables.get('can_modify'), "scope": scope,
+                                 "groupId": variables.get('group_id'), "userId": variables.get('user_id') })
+    return { id_field: target_id, "permissions": permissions, "replaceExisting": bool(re.search(r'replaceExisting\s*:\s*true', query)) }
+
+def start_mock_server(workspace, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, throttle_rate=0, filters=True):
+    # Serve the workspace from a background thread; returns the server and its GraphQL endpoint
+    handler = type('Handler', (MockGraphQLHandler,), {
+        "workspace": workspace, "latency": latency, "jitter": jitter,
+        "throttle": TokenBucket(throttle_rate) if throttle_rate else None,
+        "filters": filters, "stats": { "requests": 0, "mutations": 0, "filtered": 0, "throttled": 0 }, "stats_lock": threading.Lock()
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/graphql"
+
+def main():
+    options = Options()
+    print(f"Generating {options.groups} groups, {options.users} users, {options.folders} folders and {options.projects} projects...")
+    workspace = MockWorkspace(options.groups, options.users, options.folders, options.projects)
+    server, endpoint = start_mock_server(workspace, options.host, options.port, options.latency, options.jitter, options.throttle_rate, options.filters)
+    print(f"Mock Nexar API listening on {endpoint}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
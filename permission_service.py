@@ -0,0 +1,426 @@
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import dotenv
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import TCPServer
+from graphql_actions import permission_entry, permission_update, update_permissions_batch, iter_folders_with_permissions, iter_projects_with_permissions
+from graphql_actions import GraphQLTransport, DEFAULT_POOL_SIZE, DEFAULT_UPDATES_PER_REQUEST, DEFAULT_PAGE_SIZE
+from concurrent_executor import DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from id_cache import IdCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL
+from bulk_permissions import BulkRunner, normalize_row, describe_grant, error_messages
+from reconcile_permissions import reconcile
+from token_manager import TokenManager
+from workspace_fanout import single_workspace
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Seconds the queue waits after the first request so requests arriving together are sent in the same batch
+DEFAULT_BATCH_WINDOW = 0.02
+# Seconds after which a name that isn't found refetches its collection from the API
+DEFAULT_REFRESH_INTERVAL = 30
+# The ID indexes the service keeps in memory
+ENTITY_TYPES = ["group", "user", "folder", "project"]
+
+class Options:
+    def __init__(self):
+        # Load the environment variables from the .env file
+        dotenv.load_dotenv()
+
+        # These options can only come from the environment or the .env file
+        self.client_id = os.getenv('NEXAR_CLIENT_ID')
+        self.client_secret = os.getenv('NEXAR_CLIENT_SECRET')
+
+        # The scopes are set to the required scopes for this script
+        self.scopes = ["user.access", "design.domain"]
+
+        parsed_args = self.parse_args()
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Workspace can be passed via an argument, an environment variable, or the .env file
+        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # Clients have to send this secret as a bearer token when it is set; it can only come from the environment or the .env file
+        self.secret = os.getenv('PERMISSION_SERVICE_SECRET') or None
+
+        # The service listens on a local TCP port, or on a Unix socket when one is given
+        self.host = parsed_args.host
+        self.port = parsed_args.port
+        self.socket = parsed_args.socket
+        self.batch_window = parsed_args.batch_window
+        self.refresh_interval = parsed_args.refresh_interval
+
+        # Workspace IDs are only cached on disk when asked to
+        self.cache = parsed_args.cache or parsed_args.refresh_cache
+        self.cache_path = parsed_args.cache_path
+        self.cache_ttl = parsed_args.cache_ttl
+        self.refresh_cache = parsed_args.refresh_cache
+
+        # Connection settings for the API
+        self.pool_size = parsed_args.pool_size
+        self.timeout = parsed_args.timeout
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.updates_per_request = parsed_args.updates_per_request
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Serve folder and project permission changes over a local HTTP/JSON API')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('--host', help='The address to listen on (anything but a loopback address exposes the API to the network)', default=DEFAULT_HOST)
+        args.add_argument('--port', help='The port to listen on', type=int, default=DEFAULT_PORT)
+        args.add_argument('--socket', help='Listen on this Unix socket path instead of a TCP port')
+        args.add_argument('--batch-window', help='The number of seconds to collect requests before sending them together', type=float, default=DEFAULT_BATCH_WINDOW)
+        args.add_argument('--refresh-interval', help='The number of seconds after which a name that is not found refetches the IDs from the API', type=float, default=DEFAULT_REFRESH_INTERVAL)
+        args.add_argument('--cache', help='Cache workspace IDs on disk between runs', action='store_true')
+        args.add_argument('--cache-path', help='The path of the ID cache file', default=DEFAULT_CACHE_PATH)
+        args.add_argument('--cache-ttl', help='The number of seconds cached IDs stay valid', type=int, default=DEFAULT_CACHE_TTL)
+        args.add_argument('--refresh-cache', help='Discard the cached IDs for the workspace before starting', action='store_true')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--timeout', help='The number of seconds to wait for each API response', type=float, default=120)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--updates-per-request', help='The number of folder and project updates sent in each request', type=int, default=DEFAULT_UPDATES_PER_REQUEST)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
+        return args.parse_args()
+
+def principal_key(entry):
+    # Identifies the principal of a permission entry regardless of its access level
+    return (entry['scope'], entry.get('groupId') if entry['scope'] == "GROUP" else None, entry.get('userId') if entry['scope'] == "USER" else None)
+
+def entry_from_current(entry):
+    # Permissions read from the API carry every field; keep only the ones the update input accepts
+    principal_type = entry['scope'].lower() if entry['scope'] != "ANYONE" else "anyone"
+    principal_id = entry.get('groupId') if principal_type == "group" else entry.get('userId') if principal_type == "user" else None
+    return permission_entry(principal_type, principal_id, bool(entry['canModify']))
+
+# Grant and revoke requests from any number of clients are queued and sent by a single worker.
+# Everything queued while the previous batch was being sent (or within the batch window) goes out together:
+# all the changes for one target become a single update, and the updates are packed into as few requests as possible.
+class PermissionQueue:
+    def __init__(self, runner, concurrency=DEFAULT_CONCURRENCY, updates_per_request=DEFAULT_UPDATES_PER_REQUEST, batch_window=DEFAULT_BATCH_WINDOW):
+        self.runner = runner
+        self.concurrency = concurrency
+        self.updates_per_request = updates_per_request
+        self.batch_window = batch_window
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stats = {"grants": 0, "revokes": 0, "batches": 0, "requests": 0}
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, operation, grant):
+        # Returns a Future resolving to (succeeded, message)
+        future = Future()
+        with self.condition:
+            self.pending.append((operation, grant, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            time.sleep(self.batch_window)
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+            try:
+                self.process(batch)
+            except Exception as error:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_result((False, f"Failed to apply the change: {error}"))
+
+    def process(self, batch):
+        runner = self.runner
+        targets = {}
+        for operation, grant, future in batch:
+            self.stats['grants' if operation == "grant" else 'revokes'] += 1
+            message = runner.missing(grant)
+            if message is not None:
+                future.set_result((False, message))
+                continue
+            targets.setdefault((grant['target_type'], grant['target']), []).append((operation, grant, future))
+        if not targets:
+            return
+
+        # Revoking has to replace the whole list, so the current permissions of those targets are read first
+        revoked = {}
+        for target_type in ["folder", "project"]:
+            target_ids = { runner.resolve(target_type, target) for (changed_type, target), changes in targets.items()
+                           if changed_type == target_type and any(operation == "revoke" for operation, _, _ in changes) }
+            if target_ids:
+                revoked.update(self.current_permissions(target_type, target_ids))
+
+        updates = []
+        sent = []
+        for (target_type, target), changes in targets.items():
+            target_id = runner.resolve(target_type, target)
+            if target_id in revoked:
+                # Apply the changes in the order they were received on top of the current permissions
+                entries = { principal_key(entry): entry for entry in revoked[target_id] }
+                for operation, grant, _ in changes:
+                    entry = self.entry(grant)
+                    if operation == "grant":
+                        entries[principal_key(entry)] = entry
+                    else:
+                        entries.pop(principal_key(entry), None)
+                updates.append(permission_update(target_type, target_id, list(entries.values()), replace_existing=True))
+            else:
+                # Without the current permissions a revoke can't be applied; sending it as an update would grant it instead
+                for operation, _, future in changes:
+                    if operation == "revoke":
+                        future.set_result((False, f"Failed to remove permission: current permissions of {target_type} '{target}' not found."))
+                changes = [change for change in changes if change[0] == "grant"]
+                if not changes:
+                    continue
+                updates.append(permission_update(target_type, target_id, [self.entry(grant) for _, grant, _ in changes]))
+            sent.append(changes)
+        if not updates:
+            return
+
+        results = update_permissions_batch(runner.access_token, updates, self.updates_per_request, runner.transport, self.concurrency)
+        self.stats['batches'] += 1
+        self.stats['requests'] += (len(updates) + self.updates_per_request - 1) // self.updates_per_request
+        for changes, (succeeded, errors) in zip(sent, results):
+            for operation, grant, future in changes:
+                if succeeded:
+                    future.set_result((True, f"Permission {'added' if operation == 'grant' else 'removed'} successfully."))
+                else:
+                    future.set_result((False, f"Failed to {'add' if operation == 'grant' else 'remove'} permission: {error_messages(errors)}"))
+
+    def entry(self, grant):
+        principal_id = self.runner.resolve(grant['principal_type'], grant['principal']) if grant['principal_type'] != "anyone" else None
+        return permission_entry(grant['principal_type'], principal_id, grant['can_modify'])
+
+    def current_permissions(self, target_type, target_ids):
+        # Returns {target_id: [permission entries]}, stopping as soon as every target has been seen
+        runner = self.runner
+        if target_type == "folder":
+            items = iter_folders_with_permissions(runner.access_token, runner.workspace_url, runner.transport)
+        else:
+            items = iter_projects_with_permissions(runner.access_token, runner.workspace_url, transport=runner.transport, page_size=runner.resolver.page_size)
+        current = {}
+        for item in items:
+            if item['id'] in target_ids:
+                current[item['id']] = [entry_from_current(entry) for entry in item.get('permissions') or []]
+                if len(current) == len(target_ids):
+                    break
+        return current
+
+class PermissionService:
+    def __init__(self, runner, queue, concurrency=DEFAULT_CONCURRENCY, updates_per_request=DEFAULT_UPDATES_PER_REQUEST):
+        self.runner = runner
+        self.queue = queue
+        self.concurrency = concurrency
+        self.updates_per_request = updates_per_request
+        self.started = time.time()
+        # Reconciling reads and replaces whole lists of permissions, so only one runs at a time
+        self.reconcile_lock = threading.Lock()
+
+    def change(self, operation, body):
+        # Accepts a single grant or a list of grants; every grant gets its own result in the same order
+        grants = body if isinstance(body, list) else [body]
+        submitted = []
+        for grant in grants:
+            try:
+                grant = normalize_row(grant)
+                submitted.append((grant, self.queue.submit(operation, grant)))
+            except (ValueError, AttributeError) as error:
+                future = Future()
+                future.set_result((False, f"Invalid request: {error}"))
+                submitted.append((None, future))
+        results = []
+        for grant, future in submitted:
+            succeeded, message = future.result()
+            results.append({ "succeeded": succeeded, "message": message })
+            if grant is not None:
+                print(f"[{operation}] {'OK' if succeeded else 'FAILED'} {describe_grant(grant)}: {message}")
+        return results if isinstance(body, list) else results[0]
+
+    def reconcile(self, body):
+        rows = body.get('rows') if isinstance(body, dict) else None
+        if not isinstance(rows, list):
+            raise ValueError("Expected an object with a list of rows")
+        with self.reconcile_lock:
+            return reconcile(self.runner.access_token, self.runner.resolver, rows, self.runner.transport,
+                             bool(body.get('dry_run')), self.concurrency, self.updates_per_request)
+
+    def refresh(self, body):
+        # Forget the loaded IDs (of one entity type, or all) so they are fetched again
+        entity_type = body.get('entity_type') if isinstance(body, dict) else None
+        if entity_type is not None and entity_type not in ENTITY_TYPES:
+            raise ValueError(f"Unknown entity_type '{entity_type}', expected one of {', '.join(ENTITY_TYPES)}")
+        self.runner.resolver.invalidate(entity_type)
+        return { "refreshed": entity_type or "all" }
+
+    def status(self):
+        with self.runner.resolver.lock:
+            indexes = { entity_type: len(entries) for entity_type, entries in self.runner.resolver.indexes.items() }
+        return { "workspace": self.runner.workspace_url, "uptime": time.time() - self.started, "indexes": indexes, "queue": dict(self.queue.stats) }
+
+class PermissionRequestHandler(BaseHTTPRequestHandler):
+    # Set on the subclass created by serve()
+    service = None
+    secret = None
+
+    def authorized(self):
+        if self.secret is None:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization') or '', f"Bearer {self.secret}")
+
+    def do_GET(self):
+        if not self.authorized():
+            self.send_json(401, { "error": "Missing or wrong service secret" })
+        elif self.path == "/status":
+            self.send_json(200, self.service.status())
+        else:
+            self.send_json(404, { "error": f"Unknown path '{self.path}'" })
+
+    def do_POST(self):
+        routes = {
+            "/grant": lambda body: self.service.change("grant", body),
+            "/revoke": lambda body: self.service.change("revoke", body),
+            "/reconcile": self.service.reconcile,
+            "/refresh": self.service.refresh
+        }
+        if not self.authorized():
+            self.send_json(401, { "error": "Missing or wrong service secret" })
+            return
+        if self.path not in routes:
+            self.send_json(404, { "error": f"Unknown path '{self.path}'" })
+            return
+        if self.headers.get_content_type() != "application/json":
+            # Browsers can send other content types from any web page without asking first; JSON needs a CORS preflight, which is never allowed
+            self.send_json(415, { "error": "Content-Type must be application/json" })
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as error:
+            self.send_json(400, { "error": f"Invalid JSON: {error}" })
+            return
+        try:
+            self.send_json(200, routes[self.path](body))
+        except ValueError as error:
+            self.send_json(400, { "error": str(error) })
+        except Exception as error:
+            self.send_json(500, { "error": str(error) })
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients connected through a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "local"
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, secret=None):
+    handler = type('Handler', (PermissionRequestHandler,), { "service": service, "secret": secret })
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # Anyone who can connect can change permissions with the service's token, so only the owner may. The socket is
+        # created with those permissions: changing them after binding would leave it open to everyone for a moment.
+        previous_umask = os.umask(0o177)
+        try:
+            server = UnixHTTPServer(socket_path, handler)
+        finally:
+            os.umask(previous_umask)
+        print(f"Listening on {socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f"Listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def main():
+    # Load all the relevant environment and command line options
+    options = Options()
+
+    # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+    token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                 client_credentials=options.client_credentials, persist=options.token_cache)
+    access_token = None
+    try:
+        access_token = token_manager.access_token()
+    except:
+        access_token = None
+
+    # Validate the access token
+    if (access_token is None):
+        print("Unable to retrieve access token.")
+        exit()
+
+    # Validate the workspace
+    workspace_error = single_workspace(options.workspace)
+    if workspace_error is not None:
+        print(workspace_error)
+        exit()
+    print(f"Workspace URL: {options.workspace}")
+
+    # Anyone who can reach the service can change permissions with its token
+    if options.socket is None and not is_loopback(options.host) and options.secret is None:
+        print(f"PERMISSION_SERVICE_SECRET is required to listen on '{options.host}', which is not a loopback address.")
+        exit()
+
+    # The token, the connections and the ID indexes are kept for the lifetime of the service
+    id_cache = IdCache(options.cache_path, options.cache_ttl) if options.cache else None
+    transport = GraphQLTransport(pool_size=max(options.pool_size, options.concurrency), timeout=(10, options.timeout),
+                                 rate_limiter=TokenBucket(options.rate_limit), token_source=token_manager)
+    runner = BulkRunner(access_token, options.workspace, id_cache, transport, options.page_size)
+    runner.resolver.refresh_missing_after = options.refresh_interval
+    if options.refresh_cache:
+        runner.resolver.invalidate()
+
+    # Load every index up front so the first requests only pay for their mutation
+    runner.resolver.prefetch(ENTITY_TYPES, options.concurrency)
+    queue = PermissionQueue(runner, options.concurrency, options.updates_per_request, options.batch_window)
+    service = PermissionService(runner, queue, options.concurrency, options.updates_per_request)
+    serve(service, options.host, options.port, options.socket, options.secret)
+    transport.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
 import argparse
 import os
 import dotenv
-from graphql_actions import get_group_id, get_user_id, get_project_id, add_group_permission_to_project, add_user_permission_to_project, add_anyone_permission_to_project
-from nexar_token_py.nexar_token import get_token
+from graphql_actions import permission_entry, permission_update, update_permissions_batch, GraphQLTransport
+from concurrent_executor import run_all, DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from workspace_resolver import WorkspaceResolver
+from id_cache import IdCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL
+from token_manager import TokenManager
+from request_metrics import RequestMetrics, report, combined_metrics
+from request_plan import print_plan
+from workspace_fanout import workspace_urls, run_workspaces, print_workspace_report, DEFAULT_PARALLEL_WORKSPACES
 
 class Options:
     def __init__(self):
@@ -17,75 +24,160 @@ class Options:
         self.scopes = ["user.access", "design.domain"]
 
         parsed_args = self.parse_args()
-        
-        # Workspace can be passed via an argument, an environment variable, or the .env file
-        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Request timings are only collected when asked to
+        self.profile = parsed_args.profile or parsed_args.profile_output is not None
+        self.profile_output = parsed_args.profile_output
+
+        # A plan resolves the names and prints the updates the run would send instead of sending them
+        self.plan = parsed_args.plan
+        self.plan_latency = parsed_args.plan_latency
+
+        # Workspaces can be passed via arguments, or as a comma-separated list in an environment variable or the .env file
+        self.workspaces = workspace_urls(parsed_args.workspace, os.getenv('WORKSPACE_URL'))
+        self.parallel_workspaces = parsed_args.parallel_workspaces
         
         # Remaining values are passed through arguments
         self.project = parsed_args.project
-        self.group = parsed_args.group
-        self.user = parsed_args.user
+        self.groups = parsed_args.group or []
+        self.users = parsed_args.user or []
         self.anyone = parsed_args.anyone
         self.read_only = parsed_args.read_only
 
+        # Workspace IDs are only cached on disk when asked to
+        self.cache = parsed_args.cache or parsed_args.refresh_cache
+        self.cache_path = parsed_args.cache_path
+        self.cache_ttl = parsed_args.cache_ttl
+        self.refresh_cache = parsed_args.refresh_cache
+
+        # Limits on the requests sent to the API
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+
     def parse_args(self):
         # Add the argument parser
         args = argparse.ArgumentParser(description='Add permissions to a project')
-        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace (can be repeated to make the same change in several workspaces)', action='append')
+        args.add_argument('--parallel-workspaces', help='The number of workspaces changed at the same time', type=int, default=DEFAULT_PARALLEL_WORKSPACES)
         args.add_argument('-p', '--project', help='The name of the PROJECT which permissions should be modified', required=True)
-        args.add_argument('-g', '--group', help='The name of the GROUP to add permissions for')
-        args.add_argument('-u', '--user', help='The email of the USER to add permissions for')
+        args.add_argument('-g', '--group', help='The name of a GROUP to add permissions for (can be repeated)', action='append')
+        args.add_argument('-u', '--user', help='The email of a USER to add permissions for (can be repeated)', action='append')
         args.add_argument('-a', '--anyone', help='Control the permissions for all workspace members', action='store_true')
         args.add_argument('-r', '--read-only', help='Set the permission as read-only', action='store_false')
+        args.add_argument('--cache', help='Cache workspace IDs on disk between runs', action='store_true')
+        args.add_argument('--cache-path', help='The path of the ID cache file', default=DEFAULT_CACHE_PATH)
+        args.add_argument('--cache-ttl', help='The number of seconds cached IDs stay valid', type=int, default=DEFAULT_CACHE_TTL)
+        args.add_argument('--refresh-cache', help='Discard the cached IDs for the workspace before running', action='store_true')
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--plan', help='Look up the names and show the update requests the run would send and how long they would take, without changing any permissions', action='store_true')
+        args.add_argument('--plan-latency', help='The number of seconds per request --plan assumes instead of the latency measured for the lookups', type=float)
+        args.add_argument('--profile', help='Print the time, size and retries of the API requests by operation at the end of the run', action='store_true')
+        args.add_argument('--profile-output', help='Also write every API request to this file as JSON lines (or Prometheus metrics for a .prom file)')
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
         return args.parse_args()
 
-def group_actions(options, access_token, project_id, project_name):
-    group_name = options.group
-    group_id = None
-    if group_name is not None:
-        group_id = get_group_id(access_token, options.workspace, group_name)
+def principal_lookups(options, resolver):
+    # Find the ID of every group and user, skipping the ones that don't exist
+    lookups = []
+    for group_name in options.groups:
+        group_id = resolver.group_id(group_name)
         if group_id is None:
             print(f"Group '{group_name}' not found.")
         else:
             print(f"Group ID for '{group_name}': {group_id}")
-
-    if group_id is not None:
-        if (add_group_permission_to_project(access_token, project_id, group_id, options.read_only)):
-            print(f"{ "Read" if not options.read_only else "Write" } permission added successfully for group '{group_name}' on project '{project_name}'!")
-        else:
-            print(f"Failed to add permission for group '{group_name}' on project '{project_name}'.")
-
-def user_actions(options, access_token, project_id, project_name):
-    user_email = options.user
-    user_id = None
-    if user_email is not None:
-        user_id = get_user_id(access_token, options.workspace, user_email)
+            lookups.append(("group", group_name))
+    for user_email in options.users:
+        user_id = resolver.user_id(user_email)
         if user_id is None:
             print(f"User '{user_email}' not found.")
         else:
             print(f"User ID for '{user_email}': {user_id}")
-    
-    if user_id is not None:
-        if (add_user_permission_to_project(access_token, project_id, user_id, options.read_only)):
-            print(f"{ "Read" if not options.read_only else "Write" } permission added successfully for user '{user_email}' on project '{project_name}'!")
+            lookups.append(("user", user_email))
+    return lookups
+
+def principal_finders(options, resolver):
+    # One lookup per group and user, to run at the same time as the lookup of the target
+    return [lambda name=name: resolver.find("group", name) for name in options.groups] + [lambda email=email: resolver.find("user", email) for email in options.users]
+
+def describe_principal(principal_type, name):
+    if principal_type == "group":
+        return f"group '{name}'"
+    elif principal_type == "user":
+        return f"user '{name}'"
+    return "all workspace members"
+
+def permission_actions(options, access_token, resolver, project_name):
+    lookups = principal_lookups(options, resolver)
+    principals = lookups + ([("anyone", None)] if options.anyone else [])
+    if not principals:
+        print("No group, user or --anyone permission to add.")
+        return False
+
+    # Every permission for the project is sent in a single update
+    def project_permissions(principal_ids):
+        permissions = [permission_entry(principal_type, principal_id, options.read_only) for (principal_type, _), principal_id in zip(lookups, principal_ids)]
+        if options.anyone:
+            permissions.append(permission_entry("anyone", None, options.read_only))
+        return permissions
+
+    if options.plan:
+        permissions = project_permissions([resolver.resolve(principal_type, name) for principal_type, name in lookups])
+        print_plan(resolver.transport.metrics, [permission_update("project", resolver.resolve("project", project_name), permissions)],
+                   concurrency=options.concurrency, rate_limit=options.rate_limit, latency=options.plan_latency)
+        return True
+
+    def add_permissions(project_id, *principal_ids):
+        # Sent as a one-update batch, the same document --plan sizes
+        succeeded, errors = update_permissions_batch(access_token, [permission_update("project", project_id, project_permissions(principal_ids))], transport=resolver.transport)[0]
+        if not succeeded:
+            print(errors)
+        return succeeded
+
+    added = resolver.with_fresh_ids(add_permissions, ("project", project_name), *lookups)
+    for principal_type, name in principals:
+        if added:
+            print(f"{ "Read" if not options.read_only else "Write" } permission added successfully for {describe_principal(principal_type, name)} on project '{project_name}'!")
         else:
-            print(f"Failed to add permission for user '{user_email}' on project '{project_name}'.")
+            print(f"Failed to add permission for {describe_principal(principal_type, name)} on project '{project_name}'.")
+    return added
 
-def anyone_actions(options, access_token, project_id, project_name):
-    if (add_anyone_permission_to_project(access_token, project_id, options.read_only)):
-        print(f"{ "Read" if not options.read_only else "Write" } permission added successfully for all workspace members on project '{project_name}'!")
-    else:
-        print(f"Failed to add permission for all workspace members on project '{project_name}'.")
+def apply_to_workspace(options, access_token, token_manager, id_cache, rate_limiter, metrics, workspace):
+    # Look up the names and add the permissions in one workspace; returns whether everything succeeded
+    print(f"Workspace URL: {workspace}")
+    transport = GraphQLTransport(pool_size=max(options.concurrency, 1), rate_limiter=rate_limiter, token_source=token_manager, metrics=metrics)
+    resolver = WorkspaceResolver(access_token, workspace, id_cache, transport)
+    if options.refresh_cache:
+        resolver.invalidate()
+    try:
+        # Look up the project and the principals at the same time, asking the API for just those names where it can filter
+        project_name = options.project
+        project_id = run_all([lambda: resolver.find("project", project_name)] + principal_finders(options, resolver), options.concurrency)[0]
+        if project_id is None:
+            print(f"Project '{project_name}' not found.")
+            return False
+        print(f"Project ID for '{project_name}': {project_id}")
+
+        # Perform the action
+        return permission_actions(options, access_token, resolver, project_name)
+    finally:
+        transport.close()
 
 def main():
     # Load all the relevant environment and command line options
     options = Options()
 
-    # Fetch the access token
-    print("Fetching the access token. Please sign in using the browser...")
+    # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+    token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                 client_credentials=options.client_credentials, persist=options.token_cache)
     access_token = None
     try:
-        access_token = get_token(options.client_id, options.client_secret, options.scopes)["access_token"]
+        access_token = token_manager.access_token()
     except:
         access_token = None
 
@@ -94,27 +186,32 @@ def main():
         print("Unable to retrieve access token.")
         exit()
 
-    # Validate the workspace
-    if options.workspace is None:
+    # Validate the workspaces
+    if not options.workspaces:
         print("Workspace URL is required.")
         exit()
-    print(f"Workspace URL: {options.workspace}")
 
-    # Find the project
-    project_name = options.project
-    project_id = get_project_id(access_token, options.workspace, project_name)
-    if project_id is None:
-        print(f"Project '{project_name}' not found.")
-        exit()
-    print(f"Project ID for '{project_name}': {project_id}")
-
-    # Perform the action
-    if options.group is not None:
-        group_actions(options, access_token, project_id, project_name)
-    elif options.user is not None:
-        user_actions(options, access_token, project_id, project_name)
-    elif options.anyone is not None:
-        anyone_actions(options, access_token, project_id, project_name)
+    # The token, the ID cache and the rate limit are shared by every workspace, since they all go to the same API;
+    # each workspace has its own connections and IDs in memory
+    id_cache = IdCache(options.cache_path, options.cache_ttl) if options.cache else None
+    rate_limiter = TokenBucket(options.rate_limit)
+    # Plans always measure the lookups, to estimate the time of the updates from their latency
+    workspace_metrics = []
+    def run(workspace):
+        metrics = RequestMetrics() if options.profile or options.plan else None
+        workspace_metrics.append(metrics)
+        return apply_to_workspace(options, access_token, token_manager, id_cache, rate_limiter, metrics, workspace)
+    try:
+        if len(options.workspaces) == 1:
+            run(options.workspaces[0])
+        else:
+            results = run_workspaces(options.workspaces, run, options.parallel_workspaces)
+            print_workspace_report(results)
+            if not all(result['succeeded'] for result in results):
+                exit(1)
+    finally:
+        # The request timings of every workspace are printed together, even when the run stops early
+        report(combined_metrics(workspace_metrics) if options.profile else None, options.profile_output)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+
+DEFAULT_RATE_LIMIT = 20
+THROTTLED_STATUS_CODES = [429, 500, 502, 503, 504]
+THROTTLED_ERROR_WORDS = ["throttl", "rate limit", "too many requests"]
+# GraphQL errors that are worth retrying without slowing down
+TRANSIENT_ERROR_WORDS = ["timeout", "timed out", "temporarily unavailable", "try again"]
+
+# Token bucket shared by every thread sending requests to the API.
+# The rate is adaptive: it is halved whenever the API throttles a request and creeps back up
+# towards the configured maximum with every request that succeeds.
+class TokenBucket:
+    def __init__(self, rate, burst=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.max_rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Block until a request may be sent
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    def try_acquire(self):
+        # Take a token if one is available and return 0, otherwise return the number of seconds to wait before trying again
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def throttled(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+def json_body(response):
+    # The JSON object in the body of a response, or an empty one when it isn't JSON (such as an error page from a proxy).
+    # The body is decoded once and kept on the response, so classifying it and reading its data don't decode it again.
+    body = getattr(response, 'json_body', None)
+    if body is None:
+        try:
+            body = response.json()
+        except (ValueError, AttributeError):
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
+        response.json_body = body
+    return body
+
+def error_matches(errors, words):
+    for error in errors:
+        if not isinstance(error, dict):
+            continue
+        code = str((error.get('extensions') or {}).get('code', '')).lower()
+        message = str(error.get('message', '')).lower()
+        if any(word in code or word in message for word in words):
+            return True
+    return False
+
+def is_throttled(response):
+    # The API signals overload either with an HTTP status or with a GraphQL error
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return True
+    errors = json_body(response).get('errors') or []
+    return bool(errors) and error_matches(errors, THROTTLED_ERROR_WORDS)
+
+def is_retryable(response):
+    # Throttled requests and transient GraphQL errors are retried; anything else is a real answer
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return True
+    errors = json_body(response).get('errors') or []
+    return bool(errors) and (error_matches(errors, THROTTLED_ERROR_WORDS) or error_matches(errors, TRANSIENT_ERROR_WORDS))
+
+def retry_delay(response, attempt, base_delay=1.0, max_delay=30.0):
+    # Honour Retry-After when the API sends it, otherwise back off exponentially.
+    # The backoff is jittered so that clients retrying at the same time don't all come back at the same time.
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
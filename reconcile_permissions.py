@@ -0,0 +1,307 @@
+import argparse
+import os
+import time
+import dotenv
+from graphql_actions import permission_entry, permission_update, unique_permissions, update_permissions_batch, iter_folders_with_permissions, iter_projects_with_permissions
+from graphql_actions import GraphQLTransport, DEFAULT_POOL_SIZE, DEFAULT_UPDATES_PER_REQUEST, DEFAULT_PAGE_SIZE
+from concurrent_executor import DEFAULT_CONCURRENCY
+from rate_limiter import TokenBucket, DEFAULT_RATE_LIMIT
+from workspace_resolver import WorkspaceResolver
+from id_cache import IdCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_TTL
+from bulk_permissions import MANIFEST_FORMATS, manifest_format_from_path, read_manifest, normalize_row, describe_grant
+from state_store import StateStore, permissions_hash, DEFAULT_STATE_PATH, DEFAULT_STATE_MAX_AGE
+from token_manager import TokenManager
+from request_metrics import RequestMetrics, report
+from workspace_fanout import single_workspace
+
+class Options:
+    def __init__(self):
+        # Load the environment variables from the .env file
+        dotenv.load_dotenv()
+
+        # These options can only come from the environment or the .env file
+        self.client_id = os.getenv('NEXAR_CLIENT_ID')
+        self.client_secret = os.getenv('NEXAR_CLIENT_SECRET')
+
+        # The scopes are set to the required scopes for this script
+        self.scopes = ["user.access", "design.domain"]
+
+        parsed_args = self.parse_args()
+
+        # Tokens are saved between runs unless disabled; unattended runs can use the client credentials grant instead of the browser
+        self.token_cache = not parsed_args.no_token_cache
+        self.client_credentials = parsed_args.client_credentials or os.getenv('NEXAR_CLIENT_CREDENTIALS', '').lower() in ['1', 'true', 'yes']
+
+        # Request timings are only collected when asked to
+        self.profile = parsed_args.profile or parsed_args.profile_output is not None
+        self.profile_output = parsed_args.profile_output
+
+        # Workspace can be passed via an argument, an environment variable, or the .env file
+        self.workspace = parsed_args.workspace if (parsed_args.workspace is not None) else os.getenv('WORKSPACE_URL')
+
+        # Remaining values are passed through arguments
+        self.manifest = parsed_args.manifest
+        self.format = parsed_args.format if (parsed_args.format is not None) else manifest_format_from_path(parsed_args.manifest)
+        self.dry_run = parsed_args.dry_run
+
+        # Workspace IDs are only cached on disk when asked to
+        self.cache = parsed_args.cache or parsed_args.refresh_cache
+        self.cache_path = parsed_args.cache_path
+        self.cache_ttl = parsed_args.cache_ttl
+        self.refresh_cache = parsed_args.refresh_cache
+
+        # The state store is only used when asked to
+        self.state = parsed_args.state or parsed_args.full
+        self.state_path = parsed_args.state_path
+        self.state_max_age = parsed_args.state_max_age
+        self.full = parsed_args.full
+
+        # Connection settings for the API
+        self.pool_size = parsed_args.pool_size
+        self.timeout = parsed_args.timeout
+        self.concurrency = parsed_args.concurrency
+        self.rate_limit = parsed_args.rate_limit
+        self.updates_per_request = parsed_args.updates_per_request
+        self.page_size = parsed_args.page_size
+
+    def parse_args(self):
+        # Add the argument parser
+        args = argparse.ArgumentParser(description='Make the permissions of folders and projects match a desired-state manifest')
+        args.add_argument('-w', '--workspace', help='The URL of the workspace')
+        args.add_argument('-m', '--manifest', help='The path of the MANIFEST listing the complete permissions of each folder and project', required=True)
+        args.add_argument('--format', help='The format of the manifest (detected from the file extension by default)', choices=MANIFEST_FORMATS)
+        args.add_argument('-n', '--dry-run', help='Show the changes without applying them', action='store_true')
+        args.add_argument('--cache', help='Cache workspace IDs on disk between runs', action='store_true')
+        args.add_argument('--cache-path', help='The path of the ID cache file', default=DEFAULT_CACHE_PATH)
+        args.add_argument('--cache-ttl', help='The number of seconds cached IDs stay valid', type=int, default=DEFAULT_CACHE_TTL)
+        args.add_argument('--refresh-cache', help='Discard the cached IDs for the workspace before running', action='store_true')
+        args.add_argument('--state', help='Skip the folders and projects whose name and manifest permissions are unchanged since the last run', action='store_true')
+        args.add_argument('--state-path', help='The path of the state file', default=DEFAULT_STATE_PATH)
+        args.add_argument('--state-max-age', help='The number of seconds after which unchanged folders and projects are compared with the workspace again', type=int, default=DEFAULT_STATE_MAX_AGE)
+        args.add_argument('--full', help='Compare every folder and project in the manifest with the workspace and rewrite their state', action='store_true')
+        args.add_argument('--pool-size', help='The maximum number of connections kept open to the API', type=int, default=DEFAULT_POOL_SIZE)
+        args.add_argument('--timeout', help='The number of seconds to wait for each API response', type=float, default=120)
+        args.add_argument('--concurrency', help='The number of requests sent to the API at the same time', type=int, default=DEFAULT_CONCURRENCY)
+        args.add_argument('--rate-limit', help='The maximum number of requests sent to the API per second', type=float, default=DEFAULT_RATE_LIMIT)
+        args.add_argument('--updates-per-request', help='The number of folder and project updates sent in each request', type=int, default=DEFAULT_UPDATES_PER_REQUEST)
+        args.add_argument('--page-size', help='The number of projects fetched per request when listing projects', type=int, default=DEFAULT_PAGE_SIZE)
+        args.add_argument('--profile', help='Print the time, size and retries of the API requests by operation at the end of the run', action='store_true')
+        args.add_argument('--profile-output', help='Also write every API request to this file as JSON lines (or Prometheus metrics for a .prom file)')
+        args.add_argument('--no-token-cache', help='Do not save or reuse the access token between runs', action='store_true')
+        args.add_argument('--client-credentials', help='Authenticate with the client credentials instead of signing in with the browser', action='store_true')
+        return args.parse_args()
+
+def permission_key(entry):
+    # Permissions are compared by principal and access level, ignoring their order and any other fields
+    scope = entry['scope']
+    principal_id = entry.get('groupId') if scope == "GROUP" else entry.get('userId') if scope == "USER" else None
+    return (scope, principal_id, bool(entry['canModify']))
+
+def permission_set(entries):
+    return frozenset(permission_key(entry) for entry in entries or [])
+
+def desired_state(resolver, rows):
+    # Returns {(target_type, target): [permission entries]} for the manifest, and the (principal_type, principal, can_modify)
+    # grants behind the entries of each target so they can be looked up again; rows that can't be resolved are reported and skipped
+    desired = {}
+    grants = {}
+    for line_number, row in enumerate(rows, start=1):
+        try:
+            grant = normalize_row(row)
+        except (ValueError, AttributeError) as error:
+            print(f"[{line_number}] Invalid row: {error}")
+            continue
+        principal_id = None
+        if grant['principal_type'] != "anyone":
+            principal_id = resolver.resolve(grant['principal_type'], grant['principal'])
+            if principal_id is None:
+                print(f"[{line_number}] Skipped {describe_grant(grant)}: {grant['principal_type'].capitalize()} '{grant['principal']}' not found.")
+                continue
+        desired.setdefault((grant['target_type'], grant['target']), []).append(permission_entry(grant['principal_type'], principal_id, grant['can_modify']))
+        grants.setdefault((grant['target_type'], grant['target']), []).append((grant['principal_type'], grant['principal'], grant['can_modify']))
+    return desired, grants
+
+def current_state(access_token, workspace_url, target_types, transport=None, page_size=DEFAULT_PAGE_SIZE, project_ids=None):
+    # Returns {(target_type, target): (target_id, [permission entries])} for every folder and project of the requested types.
+    # When project_ids is given, project pages stop being fetched once all of those projects have been seen.
+    current = {}
+    if "folder" in target_types:
+        for folder in iter_folders_with_permissions(access_token, workspace_url, transport):
+            current[("folder", folder['path'])] = (folder['id'], folder.get('permissions') or [])
+    if "project" in target_types and project_ids != set():
+        remaining = set(project_ids) if project_ids is not None else None
+        for project in iter_projects_with_permissions(access_token, workspace_url, transport=transport, page_size=page_size):
+            current[("project", project['name'])] = (project['id'], project.get('permissions') or [])
+            if remaining is not None:
+                remaining.discard(project['id'])
+                if not remaining:
+                    break
+    return current
+
+def changed_targets(resolver, desired, state_store):
+    # Split the manifest targets into the ones to compare with the workspace and the number that can be skipped:
+    # a target is skipped when its ID still has the same name and desired permissions as when it was last applied.
+    # Only the ID and name lists are fetched, so nothing is read for the targets that are skipped.
+    recorded = state_store.load(resolver.workspace_url)
+    if not recorded:
+        # Nothing can be skipped on the first run, so the listings would only cost time
+        return desired, 0, None
+    listings = { target_type: resolver.fetch_index(target_type) for target_type in { target_type for target_type, _ in desired } }
+    candidates = {}
+    skipped = 0
+    for (target_type, target), entries in desired.items():
+        target_id = listings[target_type].get(target)
+        wanted = permissions_hash(permission_set(unique_permissions(entries)))
+        if target_id is not None and recorded.get((target_type, target_id)) == (target, wanted):
+            skipped += 1
+        else:
+            candidates[(target_type, target)] = entries
+    return candidates, skipped, listings
+
+def describe_permission(resolver, key):
+    scope, principal_id, can_modify = key
+    if scope == "GROUP":
+        principal = f"group '{resolver.name('group', principal_id) or principal_id}'"
+    elif scope == "USER":
+        principal = f"user '{resolver.name('user', principal_id) or principal_id}'"
+    else:
+        principal = "all workspace members"
+    return f"{principal} ({'write' if can_modify else 'read'})"
+
+def plan_changes(desired, current):
+    # Returns the targets whose current permissions differ from the desired ones, and the targets that don't exist
+    changes = []
+    missing = []
+    for (target_type, target), entries in desired.items():
+        if (target_type, target) not in current:
+            missing.append((target_type, target))
+            continue
+        target_id, current_entries = current[(target_type, target)]
+        wanted = permission_set(unique_permissions(entries))
+        existing = permission_set(current_entries)
+        if wanted != existing:
+            changes.append((target_type, target, target_id, entries, wanted - existing, existing - wanted))
+    return changes, missing
+
+def apply_changes(access_token, resolver, changes, grants, transport=None, concurrency=DEFAULT_CONCURRENCY, updates_per_request=DEFAULT_UPDATES_PER_REQUEST):
+    # Replace the permissions of every changed target, packing several targets into each request. Targets that fail
+    # while using group or user IDs read from the cache are sent again once with fresh IDs.
+    # Returns a result and the entries sent per change, and the number of requests sent
+    sent = {}
+    requests = [0]
+
+    def build(change):
+        target_type, target, target_id = change[:3]
+        principal_types = { principal_type for principal_type, _, _ in grants[(target_type, target)] if principal_type != "anyone" }
+        entries = []
+        for principal_type, principal, can_modify in grants[(target_type, target)]:
+            principal_id = resolver.resolve(principal_type, principal) if principal_type != "anyone" else None
+            if principal_type != "anyone" and principal_id is None:
+                return None, principal_types
+            entries.append(permission_entry(principal_type, principal_id, can_modify))
+        sent[(target_type, target)] = entries
+        return permission_update(target_type, target_id, entries, replace_existing=True), principal_types
+
+    def send(updates):
+        requests[0] += (len(updates) + updates_per_request - 1) // updates_per_request
+        return update_permissions_batch(access_token, updates, updates_per_request, transport, concurrency)
+
+    results = resolver.send_with_fresh_ids(changes, build, send)
+    return results, [sent.get((target_type, target)) for target_type, target, _, _, _, _ in changes], requests[0]
+
+def reconcile(access_token, resolver, rows, transport=None, dry_run=False, concurrency=DEFAULT_CONCURRENCY, updates_per_request=DEFAULT_UPDATES_PER_REQUEST,
+              state_store=None, full=False):
+    # With a state store, only the targets that are new, renamed or changed in the manifest since the last run
+    # (or not compared for state_store.max_age seconds) are read and updated, unless full is set
+    start = time.monotonic()
+    desired, grants = desired_state(resolver, rows)
+    targets = len(desired)
+    skipped = 0
+    project_ids = None
+    if state_store is not None and not full:
+        desired, skipped, listings = changed_targets(resolver, desired, state_store)
+        if listings is not None:
+            # Projects missing from the fresh listing don't exist, so only the listed ones need to be found in the pages
+            project_ids = { listings["project"][target] for target_type, target in desired if target_type == "project" and target in listings["project"] }
+    target_types = { target_type for target_type, _ in desired }
+    current = current_state(access_token, resolver.workspace_url, target_types, transport, resolver.page_size, project_ids)
+    changes, missing = plan_changes(desired, current)
+
+    for target_type, target in missing:
+        print(f"{target_type.capitalize()} '{target}' not found.")
+    for target_type, target, _, _, added, removed in changes:
+        print(f"{target_type.capitalize()} '{target}':")
+        for key in sorted(added, key=str):
+            print(f"  + {describe_permission(resolver, key)}")
+        for key in sorted(removed, key=str):
+            print(f"  - {describe_permission(resolver, key)}")
+
+    summary = {"targets": targets, "skipped": skipped, "unchanged": len(desired) - len(changes) - len(missing), "changed": len(changes),
+               "missing": len(missing), "failed": 0, "requests": 0}
+    failed = set()
+    if not dry_run and changes:
+        results, sent, summary['requests'] = apply_changes(access_token, resolver, changes, grants, transport, concurrency, updates_per_request)
+        for (target_type, target, _, _, _, _), (succeeded, errors), entries in zip(changes, results, sent):
+            if succeeded:
+                # A retry may have sent fresh IDs, so record what was actually applied
+                desired[(target_type, target)] = entries
+            else:
+                summary['failed'] += 1
+                failed.add((target_type, target))
+                print(f"Failed to update {target_type} '{target}': {'; '.join(error.get('message', str(error)) for error in errors)}")
+    if state_store is not None and not dry_run:
+        # Record every target that now has its desired permissions
+        state_store.record(resolver.workspace_url, [(target_type, current[(target_type, target)][0], target, permission_set(unique_permissions(entries)))
+                                                    for (target_type, target), entries in desired.items()
+                                                    if (target_type, target) in current and (target_type, target) not in failed])
+    summary['elapsed'] = time.monotonic() - start
+    return summary
+
+def print_summary(summary, dry_run=False):
+    skipped = f"{summary['skipped']} skipped as unchanged since the last run, " if summary.get('skipped') else ""
+    print(f"Reconciled {summary['targets']} targets in {summary['elapsed']:.2f}s: {skipped}{summary['unchanged']} unchanged, "
+          f"{summary['changed']} {'to change' if dry_run else 'changed'}, {summary['missing']} not found, {summary['failed']} failed, "
+          f"{summary['requests']} update requests sent.")
+
+def main():
+    # Load all the relevant environment and command line options
+    options = Options()
+
+    # Fetch the access token, reusing the one saved by an earlier run while it is still valid
+    token_manager = TokenManager(options.client_id, options.client_secret, options.scopes,
+                                 client_credentials=options.client_credentials, persist=options.token_cache)
+    access_token = None
+    try:
+        access_token = token_manager.access_token()
+    except:
+        access_token = None
+
+    # Validate the access token
+    if (access_token is None):
+        print("Unable to retrieve access token.")
+        exit()
+
+    # Validate the workspace
+    workspace_error = single_workspace(options.workspace)
+    if workspace_error is not None:
+        print(workspace_error)
+        exit()
+    print(f"Workspace URL: {options.workspace}")
+
+    # Compare the workspace with the manifest and apply the differences
+    id_cache = IdCache(options.cache_path, options.cache_ttl) if options.cache else None
+    metrics = RequestMetrics() if options.profile else None
+    transport = GraphQLTransport(pool_size=max(options.pool_size, options.concurrency), timeout=(10, options.timeout),
+                                 rate_limiter=TokenBucket(options.rate_limit), token_source=token_manager, metrics=metrics)
+    resolver = WorkspaceResolver(access_token, options.workspace, id_cache, transport, options.page_size)
+    if options.refresh_cache:
+        resolver.invalidate()
+    state_store = StateStore(options.state_path, options.state_max_age) if options.state else None
+    summary = reconcile(access_token, resolver, read_manifest(options.manifest, options.format), transport,
+                        options.dry_run, options.concurrency, options.updates_per_request, state_store, options.full)
+    print_summary(summary, options.dry_run)
+    report(metrics, options.profile_output)
+    transport.close()
+
+if __name__ == "__main__":
+    main()
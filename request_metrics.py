@@ -0,0 +1,139 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+
+OPERATION_PATTERN = re.compile(r'\b(?:query|mutation)\s+(\w+)')
+PERCENTILES = [50, 95, 99]
+EXPORT_FORMATS = ["jsonl", "prometheus"]
+
+# Records every GraphQL call sent through a transport: the operation name, the wall time including retries
+# and rate limiting, the bytes sent and received, the final HTTP status and the number of retries.
+# Shared by every thread using the transport.
+class RequestMetrics:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, operation, elapsed, bytes_sent, bytes_received, status, retries):
+        # status is None when the request failed without a response
+        entry = {
+            "timestamp": time.time(),
+            "operation": operation,
+            "elapsed": elapsed,
+            "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received,
+            "status": status,
+            "retries": retries
+        }
+        with self.lock:
+            self.records.append(entry)
+
+    def summary(self):
+        # Returns {operation: statistics} with the latency percentiles of each operation
+        with self.lock:
+            records = list(self.records)
+        operations = {}
+        for entry in records:
+            operations.setdefault(entry['operation'], []).append(entry)
+        summary = {}
+        for operation, entries in sorted(operations.items()):
+            latencies = sorted(entry['elapsed'] for entry in entries)
+            statistics = {
+                "count": len(entries),
+                "errors": sum(1 for entry in entries if entry['status'] != 200),
+                "retries": sum(entry['retries'] for entry in entries),
+                "total": sum(latencies),
+                "bytes_sent": sum(entry['bytes_sent'] for entry in entries),
+                "bytes_received": sum(entry['bytes_received'] for entry in entries)
+            }
+            for percentile in PERCENTILES:
+                statistics[f"p{percentile}"] = percentile_of(latencies, percentile)
+            summary[operation] = statistics
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            print("No API requests were sent.")
+            return
+        print(f"{'Operation':<24} {'Calls':>6} {'Errors':>6} {'Retries':>7} {'Total s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'Sent KB':>8} {'Recv KB':>8}")
+        for operation, statistics in sorted(summary.items(), key=lambda item: -item[1]['total']):
+            print(f"{operation:<24} {statistics['count']:>6} {statistics['errors']:>6} {statistics['retries']:>7} {statistics['total']:>8.2f} "
+                  f"{statistics['p50'] * 1000:>8.1f} {statistics['p95'] * 1000:>8.1f} {statistics['p99'] * 1000:>8.1f} "
+                  f"{statistics['bytes_sent'] / 1024:>8.1f} {statistics['bytes_received'] / 1024:>8.1f}")
+
+    def write_jsonl(self, path):
+        # One line per request, in the order they completed
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w') as trace:
+            for entry in records:
+                trace.write(json.dumps(entry) + "\n")
+
+    def write_prometheus(self, path):
+        # Prometheus text exposition format, one summary per operation
+        lines = [
+            "# HELP nexar_graphql_request_seconds Wall time of GraphQL requests including retries.",
+            "# TYPE nexar_graphql_request_seconds summary"
+        ]
+        summary = self.summary()
+        for operation, statistics in summary.items():
+            for percentile in PERCENTILES:
+                lines.append(f'nexar_graphql_request_seconds{{operation="{operation}",quantile="{percentile / 100}"}} {statistics[f"p{percentile}"]}')
+            lines.append(f'nexar_graphql_request_seconds_sum{{operation="{operation}"}} {statistics["total"]}')
+            lines.append(f'nexar_graphql_request_seconds_count{{operation="{operation}"}} {statistics["count"]}')
+        for name, key, description in [("errors", "errors", "GraphQL requests that did not end with HTTP 200."),
+                                       ("retries", "retries", "Retries of GraphQL requests."),
+                                       ("sent_bytes", "bytes_sent", "Bytes sent in GraphQL request bodies."),
+                                       ("received_bytes", "bytes_received", "Bytes received in GraphQL response bodies.")]:
+            lines.append(f"# HELP nexar_graphql_request_{name}_total {description}")
+            lines.append(f"# TYPE nexar_graphql_request_{name}_total counter")
+            for operation, statistics in summary.items():
+                lines.append(f'nexar_graphql_request_{name}_total{{operation="{operation}"}} {statistics[key]}')
+        with open(path, 'w') as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+
+    def write(self, path, export_format=None):
+        export_format = export_format if export_format is not None else export_format_from_path(path)
+        if export_format == "prometheus":
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
+
+def combined_metrics(metrics_list):
+    # The records of several RequestMetrics (such as one per workspace) in one, in the order they completed
+    combined = RequestMetrics()
+    for metrics in metrics_list:
+        if metrics is not None:
+            combined.records.extend(metrics.records)
+    combined.records.sort(key=lambda entry: entry['timestamp'])
+    return combined
+
+def operation_name(query):
+    match = OPERATION_PATTERN.search(query)
+    return match.group(1) if match else "anonymous"
+
+def percentile_of(sorted_values, percentile):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def export_format_from_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.prom', '.txt']:
+        return "prometheus"
+    return "jsonl"
+
+def report(metrics, output_path=None):
+    # Print the summary at the end of a run and write the export when asked to
+    if metrics is None:
+        return
+    metrics.print_summary()
+    if output_path is not None:
+        metrics.write(output_path)
+        print(f"Request metrics written to '{output_path}'.")
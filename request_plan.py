@@ -0,0 +1,64 @@
+import json
+import math
+from graphql_actions import permission_updates_document, DEFAULT_UPDATES_PER_REQUEST
+from concurrent_executor import DEFAULT_CONCURRENCY
+from request_metrics import percentile_of
+
+# Seconds assumed per request when no request was measured during the run (every ID came from the cache)
+DEFAULT_PLAN_LATENCY = 0.5
+
+# Works out the mutations a run would send, without sending them: the same documents as update_permissions_batch,
+# their exact request sizes, and an estimate of the time they take from the latency measured for the lookups.
+
+def planned_documents(updates, updates_per_request=DEFAULT_UPDATES_PER_REQUEST):
+    # One (query, variables) document per request, batched like update_permissions_batch
+    return [permission_updates_document(updates[start:start + updates_per_request]) for start in range(0, len(updates), updates_per_request)]
+
+def document_sizes(query, variables):
+    # The bytes of the request body, and of the response when every update succeeds
+    sent = len(json.dumps({ "query": query, "variables": variables }).encode())
+    results = { alias.replace("input", "update"): { "folderId" if "folderId" in update else "projectId": update.get('folderId') or update.get('projectId') }
+                for alias, update in variables.items() }
+    received = len(json.dumps({ "data": results }).encode())
+    return sent, received
+
+def estimated_seconds(requests, latency, concurrency=DEFAULT_CONCURRENCY, rate_limit=None):
+    # Requests go out concurrency at a time, and no faster than the rate limit once its first burst is spent
+    if requests == 0:
+        return 0.0
+    seconds = math.ceil(requests / max(1, concurrency)) * latency
+    if rate_limit:
+        seconds = max(seconds, max(0, requests - max(1.0, rate_limit)) / rate_limit + latency)
+    return seconds
+
+def measured_latency(metrics):
+    # The median latency of the requests sent so far, or None when none were sent
+    if metrics is None or not metrics.records:
+        return None
+    return percentile_of(sorted(entry['elapsed'] for entry in metrics.records), 50)
+
+def print_plan(metrics, updates, updates_per_request=DEFAULT_UPDATES_PER_REQUEST, concurrency=DEFAULT_CONCURRENCY, rate_limit=None, latency=None):
+    lookups = list(metrics.records) if metrics is not None else []
+    if lookups:
+        print(f"Lookups: {len(lookups)} requests sent to resolve the names, {sum(entry['bytes_sent'] for entry in lookups) / 1024:.1f} KB sent, "
+              f"{sum(entry['bytes_received'] for entry in lookups) / 1024:.1f} KB received in {sum(entry['elapsed'] for entry in lookups):.2f}s of requests.")
+    else:
+        print("Lookups: every ID came from the cache, no requests sent.")
+
+    documents = planned_documents(updates, updates_per_request)
+    sizes = [document_sizes(query, variables) for query, variables in documents]
+    target_types = sorted({ update['target_type'] for update in updates })
+    print(f"Updates: {len(updates)} {' and '.join(f'{target_type}s' for target_type in target_types) or 'targets'} in {len(documents)} requests "
+          f"(up to {updates_per_request} per request), {sum(sent for sent, _ in sizes) / 1024:.1f} KB sent, about {sum(received for _, received in sizes) / 1024:.1f} KB received.")
+
+    source = "given"
+    if latency is None:
+        latency = measured_latency(metrics)
+        source = "measured"
+    if latency is None:
+        latency = DEFAULT_PLAN_LATENCY
+        source = "assumed"
+    limit = f", at most {rate_limit:g} requests per second" if rate_limit else ""
+    print(f"Estimated time for the updates: {estimated_seconds(len(documents), latency, concurrency, rate_limit):.2f}s "
+          f"at {latency * 1000:.0f} ms per request ({source}), {concurrency} at a time{limit}.")
+    print("Plan only: no permissions were changed.")
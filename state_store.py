@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from id_cache import cache_key
+
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nexar_permissions', 'state.sqlite')
+# Targets whose permissions haven't been compared with the API for this long are checked again, to catch changes made elsewhere
+DEFAULT_STATE_MAX_AGE = 7 * 24 * 60 * 60
+
+# On-disk record of the permissions last applied to (or found on) each folder and project by reconcile_permissions.py,
+# keyed by target ID so renames are noticed. A target whose name and desired permissions match its record
+# can be skipped without reading its permissions from the API.
+class StateStore:
+    def __init__(self, path=DEFAULT_STATE_PATH, max_age=DEFAULT_STATE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self.connect()) as connection, connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS targets (
+                    workspace_url TEXT NOT NULL,
+                    target_type TEXT NOT NULL,
+                    target_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    permissions_hash TEXT NOT NULL,
+                    permissions TEXT NOT NULL,
+                    checked_at REAL NOT NULL,
+                    PRIMARY KEY (workspace_url, target_type, target_id)
+                )
+            ''')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, workspace_url):
+        # Returns {(target_type, target_id): (name, permissions_hash)} for the records younger than max_age
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                'SELECT target_type, target_id, name, permissions_hash FROM targets WHERE workspace_url = ? AND checked_at >= ?',
+                (cache_key(workspace_url), time.time() - self.max_age)
+            ).fetchall()
+        return { (target_type, target_id): (name, permissions_hash) for target_type, target_id, name, permissions_hash in rows }
+
+    def record(self, workspace_url, entries):
+        # entries: [(target_type, target_id, name, permission keys)] whose permissions now match the API
+        checked_at = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO targets (workspace_url, target_type, target_id, name, permissions_hash, permissions, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(cache_key(workspace_url), target_type, target_id, name, permissions_hash(keys), json.dumps(sorted(keys, key=str)), checked_at)
+                 for target_type, target_id, name, keys in entries]
+            )
+
+def permissions_hash(keys):
+    # The same set of (scope, principal ID, can_modify) keys always gives the same hash, whatever their order
+    return hashlib.sha256(json.dumps(sorted(keys, key=str)).encode()).hexdigest()
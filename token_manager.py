@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+
+TOKEN_ENDPOINT = 'https://identity.nexar.com/connect/token'
+DEFAULT_TOKEN_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'nexar_permissions', 'tokens')
+# Tokens are renewed this many seconds before they expire so no request is sent with a token about to expire
+EXPIRY_MARGIN = 120
+
+# Provides a valid access token for as long as it is needed.
+# Tokens are saved on disk (readable only by the current user) and reused by later runs until they are about to expire,
+# then renewed silently with the refresh token. Without a usable refresh token, a new token is fetched either with the
+# client credentials grant (for unattended runs) or through the interactive browser sign-in.
+class TokenManager:
+    def __init__(self, client_id, client_secret, scopes, token_directory=DEFAULT_TOKEN_DIRECTORY, client_credentials=False, persist=True):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.client_credentials = client_credentials
+        # offline_access is what makes the identity server issue a refresh token for the interactive sign-in
+        self.scopes = list(scopes) if client_credentials or "offline_access" in scopes else list(scopes) + ["offline_access"]
+        self.path = os.path.join(token_directory, token_file_name(client_id, self.scopes, client_credentials)) if persist else None
+        self.token = None
+        self.lock = threading.Lock()
+
+    def access_token(self):
+        with self.lock:
+            if self.token is None:
+                self.token = self.load()
+            if self.token is None or expires_soon(self.token):
+                self.token = self.renew(self.token)
+                self.save(self.token)
+            return self.token['access_token']
+
+    def refresh(self, rejected_token=None):
+        # Called when the API rejects a token; other threads may already have replaced it
+        with self.lock:
+            if self.token is not None and rejected_token is not None and self.token['access_token'] != rejected_token:
+                return self.token['access_token']
+            self.token = self.renew(self.token)
+            self.save(self.token)
+            return self.token['access_token']
+
+    def renew(self, token):
+        if token is not None and token.get('refresh_token'):
+            try:
+                return self.request_token({ "grant_type": "refresh_token", "refresh_token": token['refresh_token'] })
+            except requests.RequestException:
+                pass
+        if self.client_credentials:
+            return self.request_token({ "grant_type": "client_credentials", "scope": " ".join(self.scopes) })
+        return self.sign_in()
+
+    def request_token(self, data):
+        data = dict(data, client_id=self.client_id, client_secret=self.client_secret)
+        response = requests.post(TOKEN_ENDPOINT, data=data, timeout=30)
+        response.raise_for_status()
+        token = response.json()
+        if not token.get('refresh_token') and data['grant_type'] == "refresh_token":
+            # Keep using the current refresh token when the identity server doesn't rotate it
+            token['refresh_token'] = data['refresh_token']
+        return with_expiry(token)
+
+    def sign_in(self):
+        # The browser sign-in is only needed when there is no token to reuse or refresh
+        from nexar_token_py.nexar_token import get_token
+        print("Fetching the access token. Please sign in using the browser...")
+        return with_expiry(dict(get_token(self.client_id, self.client_secret, self.scopes)))
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as token_file:
+                return json.load(token_file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, token):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        # Write to a private temporary file and swap it in so the token file is never readable by others or half-written
+        temporary_path = self.path + ".tmp"
+        descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as token_file:
+            json.dump(token, token_file)
+        os.replace(temporary_path, self.path)
+
+def token_file_name(client_id, scopes, client_credentials):
+    key = json.dumps([client_id, sorted(scopes), client_credentials])
+    return hashlib.sha256(key.encode()).hexdigest()[:32] + ".json"
+
+def with_expiry(token):
+    # Record when the token expires as an absolute time so it can be checked by later runs
+    if 'expires_at' not in token:
+        if 'expires_in' in token:
+            token['expires_at'] = time.time() + float(token['expires_in'])
+        else:
+            token['expires_at'] = jwt_expiry(token['access_token'])
+    return token
+
+def jwt_expiry(access_token):
+    # Access tokens are JWTs; without an expires_in the expiry is read from the token itself
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, ValueError):
+        return 0
+
+def expires_soon(token):
+    return float(token.get('expires_at') or 0) - EXPIRY_MARGIN <= time.time()
@@ -0,0 +1,79 @@
+import io
+import sys
+import threading
+import time
+from concurrent_executor import run_ordered
+
+DEFAULT_PARALLEL_WORKSPACES = 4
+
+# Runs the same action against several workspaces at the same time. What each workspace prints is collected
+# separately and printed as one block, in the order the workspaces were given, followed by a combined report.
+
+# Stands in for sys.stdout, sending what a workspace's thread prints to that workspace's buffer
+class WorkspaceOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def workspace_urls(arguments, environment_value):
+    # Workspaces from repeated -w options, or a comma-separated WORKSPACE_URL; duplicates are only run once
+    urls = arguments if arguments else (environment_value or '').split(',')
+    unique = []
+    for url in (url.strip() for url in urls):
+        if url and url not in unique:
+            unique.append(url)
+    return unique
+
+def single_workspace(value):
+    # For the scripts that work on one workspace: an error message when the URL is missing or a list, otherwise None
+    if value is None:
+        return "Workspace URL is required."
+    if ',' in value:
+        return "Only one workspace URL can be given; a comma-separated list is only accepted by folder_permissions.py and project_permissions.py."
+    return None
+
+def run_workspaces(workspaces, run, parallel=DEFAULT_PARALLEL_WORKSPACES):
+    # run(workspace_url) returns whether everything succeeded; returns one result per workspace, in order
+    output = WorkspaceOutput(sys.stdout)
+
+    def run_one(workspace):
+        output.local.buffer = io.StringIO()
+        start = time.monotonic()
+        error = None
+        try:
+            succeeded = bool(run(workspace))
+        except Exception as exception:
+            succeeded = False
+            error = str(exception) or type(exception).__name__
+        text = output.local.buffer.getvalue()
+        output.local.buffer = None
+        return { "workspace": workspace, "succeeded": succeeded, "error": error, "elapsed": time.monotonic() - start, "output": text }
+
+    results = []
+    sys.stdout = output
+    try:
+        for workspace, result in run_ordered(run_one, workspaces, parallel):
+            output.stream.write(f"=== {workspace} ===\n{result['output']}")
+            if result['error'] is not None:
+                output.stream.write(f"Stopped: {result['error']}\n")
+            output.stream.flush()
+            results.append(result)
+    finally:
+        sys.stdout = output.stream
+    return results
+
+def print_workspace_report(results):
+    width = max([len("Workspace")] + [len(result['workspace']) for result in results])
+    print(f"{'Workspace':<{width}} {'Result':<8} {'Time s':>8}")
+    for result in results:
+        status = "ok" if result['succeeded'] else "error" if result['error'] is not None else "failed"
+        print(f"{result['workspace']:<{width}} {status:<8} {result['elapsed']:>8.2f}")
+    succeeded = sum(1 for result in results if result['succeeded'])
+    print(f"{succeeded} of {len(results)} workspaces succeeded.")
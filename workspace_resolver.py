@@ -0,0 +1,255 @@
+import threading
+import time
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from graphql_actions import iter_groups, iter_users, iter_projects, iter_folders, find_id, FilterUnsupported, DEFAULT_PAGE_SIZE
+from concurrent_executor import run_all
+
+# Sorted folder paths, so a whole subtree or the matches of a glob are found with a binary search
+# instead of testing every folder in the workspace.
+class FolderPathIndex:
+    def __init__(self, folder_ids):
+        self.folder_ids = folder_ids
+        self.paths = sorted(folder_ids)
+
+    def with_prefix(self, prefix):
+        for path in self.paths[bisect_left(self.paths, prefix):]:
+            if not path.startswith(prefix):
+                return
+            yield path
+
+    def subtree(self, folder_path):
+        # The folder itself and every folder below it
+        root = folder_path.rstrip('/')
+        return [path for path in self.with_prefix(root) if path == root or path.startswith(root + '/')]
+
+    def glob(self, pattern):
+        # Only the paths sharing the pattern's literal prefix need to be matched
+        prefix = pattern
+        for wildcard in "*?[":
+            prefix = prefix.split(wildcard)[0]
+        return [path for path in self.with_prefix(prefix) if fnmatchcase(path, pattern)]
+
+    def ids(self, paths):
+        return [self.folder_ids[path] for path in paths]
+
+# Resolves group, user, project and folder names to IDs for one workspace.
+# Each collection is downloaded the first time it is needed and indexed in a dict,
+# so any number of lookups afterwards cost a single dict access.
+# When an IdCache is given, indexes are read from and written to disk so later runs can skip the downloads.
+# Long-running processes can set refresh_missing_after so a name that isn't found refetches its collection
+# when the index is older than that many seconds (entities created since it was loaded are then found).
+class WorkspaceResolver:
+    def __init__(self, access_token, workspace_url, id_cache=None, transport=None, page_size=DEFAULT_PAGE_SIZE, refresh_missing_after=None):
+        self.access_token = access_token
+        self.workspace_url = workspace_url
+        self.id_cache = id_cache
+        self.transport = transport
+        self.page_size = page_size
+        self.refresh_missing_after = refresh_missing_after
+        self.indexes = {}
+        self.loaded_at = {}
+        self.names = {}
+        # IDs located by find without loading the whole index
+        self.found = {}
+        self.folder_path_index = None
+        # Entity types whose index came from the on-disk cache rather than from the API during this run
+        self.cached_types = set()
+        # Every entity type read from the on-disk cache at some point of this run, even if refreshed since
+        self.ever_cached_types = set()
+        # Lookups may come from several threads at once; each collection must still be fetched only once
+        self.lock = threading.RLock()
+        self.fetch_locks = {}
+
+    def iter_entities(self, entity_type):
+        # Yields (name, id) pairs for the collection as they are received
+        if entity_type == "group":
+            return ((group['name'], group['id']) for group in iter_groups(self.access_token, self.workspace_url, self.transport))
+        elif entity_type == "user":
+            # Emails are matched case-insensitively
+            return ((user['email'].lower(), user['userId']) for user in iter_users(self.access_token, self.workspace_url, self.transport) if user['email'])
+        elif entity_type == "project":
+            return ((project['name'], project['id']) for project in iter_projects(self.access_token, self.workspace_url, transport=self.transport, page_size=self.page_size))
+        elif entity_type == "folder":
+            return ((folder['path'], folder['id']) for folder in iter_folders(self.access_token, self.workspace_url, self.transport))
+        raise ValueError(f"Unknown entity type '{entity_type}'")
+
+    def fetch_index(self, entity_type):
+        return dict(self.iter_entities(entity_type))
+
+    def index(self, entity_type):
+        with self.lock:
+            if entity_type in self.indexes:
+                return self.indexes[entity_type]
+            lock = self.fetch_locks.setdefault(entity_type, threading.Lock())
+        # Different collections can be fetched in parallel, the same collection only once
+        with lock:
+            with self.lock:
+                if entity_type in self.indexes:
+                    return self.indexes[entity_type]
+            entries = None
+            from_cache = False
+            if self.id_cache is not None:
+                entries = self.id_cache.load(self.workspace_url, entity_type)
+                from_cache = entries is not None
+            if entries is None:
+                entries = self.fetch_index(entity_type)
+                if self.id_cache is not None:
+                    self.id_cache.store(self.workspace_url, entity_type, entries)
+            with self.lock:
+                if from_cache:
+                    self.cached_types.add(entity_type)
+                    self.ever_cached_types.add(entity_type)
+                self.indexes[entity_type] = entries
+                self.loaded_at[entity_type] = time.monotonic()
+                return entries
+
+    def prefetch(self, entity_types, concurrency):
+        # Load several collections at the same time before they are needed
+        run_all([lambda entity_type=entity_type: self.index(entity_type) for entity_type in entity_types], concurrency)
+
+    def invalidate(self, entity_type=None):
+        # Forget the index (or all indexes) in memory and on disk so the next lookup fetches fresh data
+        with self.lock:
+            entity_types = [entity_type] if entity_type is not None else list(self.indexes)
+            for invalid_type in entity_types:
+                self.indexes.pop(invalid_type, None)
+                self.names.pop(invalid_type, None)
+                self.loaded_at.pop(invalid_type, None)
+                if invalid_type == "folder":
+                    self.folder_path_index = None
+                self.cached_types.discard(invalid_type)
+            self.found = { key: found_id for key, found_id in self.found.items() if entity_type is not None and key[0] != entity_type }
+        if self.id_cache is not None:
+            self.id_cache.invalidate(self.workspace_url, entity_type)
+
+    def resolve(self, entity_type, name):
+        if name is None:
+            return None
+        key = name.lower() if entity_type == "user" else name
+        with self.lock:
+            if entity_type not in self.indexes and (entity_type, key) in self.found:
+                return self.found[(entity_type, key)]
+        entity_id = self.index(entity_type).get(key)
+        if entity_id is None and (self.invalidate_cached(entity_type) or self.invalidate_expired(entity_type)):
+            # The entity may have been created since the index was cached or loaded
+            entity_id = self.index(entity_type).get(key)
+        return entity_id
+
+    def find(self, entity_type, name):
+        # Look up a single name. Unless the index is already loaded or will be written to the cache,
+        # the API is asked for that name alone. Where it can't filter, projects are streamed until the name is found
+        # and the other collections, which come in one response anyway, are loaded into the index.
+        with self.lock:
+            loaded = entity_type in self.indexes
+        if loaded or self.id_cache is not None:
+            return self.resolve(entity_type, name)
+        key = name.lower() if entity_type == "user" else name
+        with self.lock:
+            if (entity_type, key) in self.found:
+                return self.found[(entity_type, key)]
+        try:
+            entity_id = find_id(self.access_token, self.workspace_url, entity_type, name, self.transport)
+        except FilterUnsupported:
+            if entity_type != "project":
+                return self.resolve(entity_type, name)
+            for entity_name, entity_id in self.iter_entities(entity_type):
+                if entity_name == key:
+                    break
+            else:
+                return None
+        if entity_id is None:
+            # The filter matches emails exactly, but they are compared case-insensitively
+            return self.resolve(entity_type, name) if entity_type == "user" else None
+        with self.lock:
+            self.found[(entity_type, key)] = entity_id
+        return entity_id
+
+    def invalidate_cached(self, entity_type):
+        # Invalidate the index only if it came from the on-disk cache; returns whether it did
+        with self.lock:
+            if entity_type not in self.cached_types:
+                return False
+            self.invalidate(entity_type)
+            return True
+
+    def invalidate_expired(self, entity_type):
+        # Invalidate the index only if refresh_missing_after is set and it was loaded longer ago than that
+        with self.lock:
+            if self.refresh_missing_after is None or entity_type not in self.loaded_at:
+                return False
+            if time.monotonic() - self.loaded_at[entity_type] < self.refresh_missing_after:
+                return False
+            self.invalidate(entity_type)
+            return True
+
+    def with_fresh_ids(self, action, *lookups):
+        # Call action with the IDs for the (entity_type, name) lookups. If it fails and any of those IDs came from
+        # the on-disk cache, the cached indexes are refreshed and the action is retried once with the new IDs.
+        ids = [self.resolve(entity_type, name) for entity_type, name in lookups]
+        if action(*ids):
+            return True
+        stale_types = [entity_type for entity_type in { entity_type for entity_type, _ in lookups } if self.invalidate_cached(entity_type)]
+        if not stale_types:
+            return False
+        fresh_ids = [self.resolve(entity_type, name) for entity_type, name in lookups]
+        if None in fresh_ids or fresh_ids == ids:
+            return False
+        return action(*fresh_ids)
+
+    def send_with_fresh_ids(self, items, build, send):
+        # The batched form of with_fresh_ids. build(item) looks up the IDs of an item and returns (update, entity types used),
+        # or (None, types) when a name isn't found; send(updates) returns a (succeeded, errors) pair per update.
+        # Every update that fails while using IDs read from the cache is built again once all the cached types it used
+        # have been refreshed, and the ones whose IDs changed are sent again together. Returns a result per item.
+        built = [build(item) for item in items]
+        results = [(False, [{ "message": "Not found" }])] * len(built)
+        sendable = [index for index, (update, _) in enumerate(built) if update is not None]
+        if not sendable:
+            return results
+        for index, result in zip(sendable, send([built[index][0] for index in sendable])):
+            results[index] = result
+        with self.lock:
+            ever_cached = set(self.ever_cached_types)
+        retry = [index for index in sendable if not results[index][0] and built[index][1] & ever_cached]
+        if not retry:
+            return results
+        # Invalidate each stale type once for the whole batch; types refreshed by another batch are already fresh
+        for entity_type in set().union(*[built[index][1] for index in retry]) & ever_cached:
+            self.invalidate_cached(entity_type)
+        rebuilt = { index: build(items[index]) for index in retry }
+        resend = [index for index in retry if rebuilt[index][0] is not None and rebuilt[index][0] != built[index][0]]
+        for index, result in zip(resend, send([rebuilt[index][0] for index in resend]) if resend else []):
+            results[index] = result
+        return results
+
+    def name(self, entity_type, entity_id):
+        # Reverse lookup of an ID to its name (user emails are returned in lower case)
+        with self.lock:
+            names = self.names.get(entity_type)
+        if names is None:
+            names = { entity_id: name for name, entity_id in self.index(entity_type).items() }
+            with self.lock:
+                self.names[entity_type] = names
+        return names.get(entity_id)
+
+    def folder_tree(self):
+        with self.lock:
+            tree = self.folder_path_index
+        if tree is None:
+            tree = FolderPathIndex(self.index("folder"))
+            with self.lock:
+                self.folder_path_index = tree
+        return tree
+
+    def group_id(self, group_name):
+        return self.resolve("group", group_name)
+
+    def user_id(self, user_email):
+        return self.resolve("user", user_email)
+
+    def project_id(self, project_name):
+        return self.resolve("project", project_name)
+
+    def folder_id(self, folder_path):
+        return self.resolve("folder", folder_path)